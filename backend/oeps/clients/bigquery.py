@@ -1,13 +1,38 @@
 import io
+import decimal
 import os
+import re
 import json
+import shutil
+import hashlib
+import threading
+import time
+import uuid
 from datetime import datetime
+from functools import partial
+from itertools import chain
 from pathlib import Path
 
+import requests
+from tqdm import tqdm
 import pandas as pd
 import geopandas as gpd
 import numpy
-
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+
+from google.api_core.exceptions import (
+    BadGateway,
+    Conflict,
+    GatewayTimeout,
+    InternalServerError,
+    NotFound,
+    ServiceUnavailable,
+    TooManyRequests,
+)
+from google.auth.exceptions import TransportError
 from google.auth.transport.requests import Request
 from google.oauth2 import service_account
 from google.cloud.bigquery import (
@@ -15,9 +40,28 @@ from google.cloud.bigquery import (
     Table,
     SchemaField,
     LoadJobConfig,
+    QueryJobConfig,
+    PartitionRange,
+    RangePartitioning,
+    TimePartitioning,
 )
 
-from oeps.utils import BQ_TYPE_LOOKUP
+from oeps.config import CACHE_DIR
+from oeps.geometry import (
+    check_geometry,
+    format_geometry_report,
+    geometry_values,
+)
+from oeps.utils import (
+    BQ_TYPE_LOOKUP,
+    download_file,
+    hash_file,
+    hash_json,
+    load_json,
+    write_json,
+)
+
+BIGQUERY_CACHE_DIR = Path(CACHE_DIR, "bigquery")
 
 
 def get_client():
@@ -89,6 +133,998 @@ def get_credentials():
     return credentials
 
 
+BOOLEAN_LOOKUP = {
+    "1": True,
+    "1.0": True,
+    "Yes": True,
+    "YES": True,
+    "yes": True,
+    "True": True,
+    "TRUE": True,
+    "true": True,
+    "0": False,
+    "0.0": False,
+    "No": False,
+    "NO": False,
+    "no": False,
+    "False": False,
+    "FALSE": False,
+    "false": False,
+}
+
+# number of rows serialized at a time when streaming newline-delimited JSON
+NDJSON_BATCH_ROWS = 5000
+
+# number of rows in each row group when streaming Parquet
+PARQUET_BATCH_ROWS = 50000
+
+# Arrow types used to build Parquet files that match the BigQuery table schema.
+# NUMERIC columns must be loaded from decimals with a scale of 9.
+ARROW_TYPE_LOOKUP = {
+    "STRING": pa.string(),
+    "BOOLEAN": pa.bool_(),
+    "INTEGER": pa.int64(),
+    "DATE": pa.date32(),
+    "NUMERIC": pa.decimal128(38, 9),
+}
+
+# range of BigQuery INTEGER (int64) values
+INT64_MIN, INT64_MAX = -(2**63), 2**63 - 1
+
+# NUMERIC values must have fewer than 29 integer digits, and are stored with 9
+# decimal places. 38 digits of precision are needed to round values to that scale.
+NUMERIC_LIMIT = 1e29
+NUMERIC_SCALE = decimal.Decimal("1e-9")
+NUMERIC_CONTEXT = decimal.Context(prec=38)
+
+# errors raised by uploads and load jobs that are worth retrying. Uploads go through
+# requests, whose connection errors don't subclass the builtin ConnectionError.
+RETRY_EXCEPTIONS = (
+    BadGateway,
+    GatewayTimeout,
+    InternalServerError,
+    ServiceUnavailable,
+    TooManyRequests,
+    ConnectionError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    TransportError,
+)
+
+# column used to store row hashes in the local snapshot of each tabular resource
+ROW_HASH_COLUMN = "_row_hash"
+
+# extra field on staging tables that tells the MERGE statement what to do with a row
+CHANGE_TYPE_FIELD = {"name": "_change_type", "type": "string"}
+
+# BigQuery load job source formats, keyed by the choices in the load command
+SOURCE_FORMATS = {
+    "parquet": "PARQUET",
+    "ndjson": "NEWLINE_DELIMITED_JSON",
+}
+
+
+# query results cached locally are evicted (least recently used first) past this size
+QUERY_CACHE_MAX_BYTES = 2 * 1024**3
+
+
+def parse_floats(values: pd.Series) -> pd.Series:
+    """Parses values to floats, with NaN for values that aren't numbers. Strings are
+    parsed with float(), because pd.to_numeric() isn't correctly rounded (e.g.
+    "3.14159265358979323" becomes 3.1415926535897927)."""
+
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype(float)
+    valid = pd.to_numeric(values, errors="coerce").notna().to_numpy(bool)
+    out = pd.Series(numpy.nan, index=values.index)
+    out[valid] = values[valid].astype(str).astype(float).to_numpy()
+    return out
+
+
+def parse_integers(values: pd.Series) -> pd.Series:
+    """Parses values to Int64, with NA for values that aren't numbers or don't fit
+    in an int64 (BigQuery INTEGER). Whole numbers written as digits are parsed
+    exactly, other numbers (e.g. '23493.3434') are parsed as floats and rounded."""
+
+    text = values.astype(str).str.strip()
+    digits = text.str.fullmatch(r"[+-]?\d+").fillna(False).to_numpy(bool)
+    # up to 18 digits always fit in an int64, longer values are checked one by one
+    short = digits & (text.str.lstrip("+-").str.len() <= 18).to_numpy(bool)
+    long = digits & ~short
+
+    out = pd.Series(pd.NA, index=values.index, dtype="Int64")
+    out[short] = text[short].astype("Int64").to_numpy()
+    out[long] = [
+        i if INT64_MIN <= i <= INT64_MAX else pd.NA for i in map(int, text[long])
+    ]
+
+    floats = parse_floats(values[~digits])
+    floats = floats.where(numpy.isfinite(floats) & (floats.abs() < 2**63)).round()
+    out[~digits] = floats.astype("Int64").to_numpy()
+    return out
+
+
+def coerce_column(series: pd.Series, field_type: str):
+    """Casts a single column to the provided schema field type. Values that are
+    missing, contain "NA", or some variation of "inf" are set to null, as are values
+    that can't be cast to the field type.
+
+    Returns an object Series (with None for nulls), the null mask, and a mask of
+    the values that were nulled because they could not be cast."""
+
+    # cast all values to strings for null detection. necessary because some
+    # NULL shapefile attribute values were interpreted as float('nan'), which
+    # breaks json parsing
+    null = series.isna().to_numpy(copy=True)
+    as_str = series.astype(str)
+    null |= as_str.str.contains("NA", regex=False, na=False).to_numpy(dtype=bool)
+    # handle some infinite number variations
+    null |= as_str.str.lower().str.contains("inf", regex=False, na=False).to_numpy(bool)
+
+    values = series[~null]
+    if field_type == "string":
+        cast = as_str[~null]
+    elif field_type == "integer":
+        cast = parse_integers(values)
+    elif field_type == "number":
+        cast = parse_floats(values)
+        # values that don't fit in a BigQuery NUMERIC can't be loaded
+        cast = cast.where(~numpy.isinf(cast) & (cast.abs() < NUMERIC_LIMIT))
+    elif field_type == "boolean":
+        cast = as_str[~null].map(BOOLEAN_LOOKUP)
+    elif BQ_TYPE_LOOKUP[field_type] == "DATE":
+        cast = pd.to_datetime(values, format="%m/%d/%Y", errors="coerce")
+        cast = cast.dt.strftime("%Y-%m-%d")
+    else:
+        cast = values
+
+    failed = cast.isna().to_numpy()
+
+    # booleans that aren't found in the lookup are set to null without complaint
+    invalid = numpy.zeros(len(series), dtype=bool)
+    if field_type != "boolean":
+        invalid[~null] = failed
+    null[~null] = failed
+
+    out = numpy.full(len(series), None, dtype=object)
+    out[~null] = cast[~failed].astype(object).to_numpy()
+
+    return pd.Series(out, index=series.index, dtype=object), null, invalid
+
+
+def coerce_dataframe(df: pd.DataFrame, fields: list):
+    """Casts every schema field present in the dataframe to its schema type,
+    one column at a time.
+
+    Returns the new dataframe and a report with per-column counts of coerced
+    (non-null, cast) and nulled values, as well as values that were nulled because
+    they could not be cast to the field type."""
+
+    report = {}
+    for f in fields:
+        if f["name"] not in df.columns:
+            continue
+        out, null, invalid = coerce_column(df[f["name"]], f["type"])
+        df[f["name"]] = out
+        report[f["name"]] = {
+            "type": f["type"],
+            "coerced": int((~null).sum()),
+            "nulled": int(null.sum()),
+            "invalid": int(invalid.sum()),
+        }
+
+    return df, report
+
+
+def encode_geometry(series: pd.Series, encoding: str = "wkb") -> numpy.ndarray:
+    """Encodes a geometry column in a single shapely call, as WKB (bytes), WKT, or
+    GeoJSON (strings). Missing geometries are returned as None."""
+
+    values = geometry_values(series)
+    if encoding == "wkb":
+        return shapely.to_wkb(values)
+    if encoding == "wkt":
+        return shapely.to_wkt(values)
+    if encoding == "geojson":
+        return shapely.to_geojson(values)
+    raise ValueError(f"Invalid geometry encoding: {encoding}")
+
+
+def iter_ndjson(df: pd.DataFrame, batch_rows: int = NDJSON_BATCH_ROWS):
+    """Serializes the rows of a dataframe to newline-delimited JSON, yielding
+    utf-8 encoded chunks of at most batch_rows rows."""
+
+    columns = [i for i in df.columns if not i == "geom"]
+    for start in range(0, len(df), batch_rows):
+        batch = df.iloc[start : start + batch_rows]
+        values = [batch[col].tolist() for col in columns]
+
+        # handle geometry column by dumping it to GeoJSON string. this fixes
+        # some Polygon format errors that occurred with the default WKT that
+        # GeoPandas returns for shapes. the whole batch is encoded at once.
+        if "geom" in batch.columns:
+            values.append(encode_geometry(batch["geom"], "geojson").tolist())
+        keys = columns + ["geom"] if "geom" in batch.columns else columns
+
+        lines = [json.dumps(dict(zip(keys, row))) + "\n" for row in zip(*values)]
+        yield "".join(lines).encode("utf-8")
+
+
+def arrow_table_from_dataframe(
+    df: pd.DataFrame, fields: list, geometry_encoding: str = "wkb"
+) -> pa.Table:
+    """Builds a typed Arrow table from a coerced dataframe, using the registry field
+    types to determine the Arrow type of each column. The geom column is encoded as
+    WKB (binary) or WKT (string), both of which load into a GEOGRAPHY column."""
+
+    arrays, names = [], []
+    for f in fields:
+        if f["name"] not in df.columns:
+            continue
+        arrow_type = ARROW_TYPE_LOOKUP[BQ_TYPE_LOOKUP[f["type"]]]
+        values = df[f["name"]].tolist()
+        if arrow_type == pa.date32():
+            array = pa.array(values, type=pa.string()).cast(arrow_type)
+        elif pa.types.is_decimal(arrow_type):
+            # decimals are built from the shortest string of each float, which is
+            # what the source held, rather than from its exact binary value
+            values = [
+                None
+                if v is None
+                else NUMERIC_CONTEXT.quantize(decimal.Decimal(str(v)), NUMERIC_SCALE)
+                for v in values
+            ]
+            array = pa.array(values, type=arrow_type)
+        else:
+            array = pa.array(values, type=arrow_type)
+        arrays.append(array)
+        names.append(f["name"])
+
+    if "geom" in df.columns:
+        geom_type = pa.binary() if geometry_encoding == "wkb" else pa.string()
+        values = encode_geometry(df["geom"], geometry_encoding)
+        arrays.append(pa.array(values, type=geom_type))
+        names.append("geom")
+
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+class ParquetSink:
+    """Write-only file-like object that collects the bytes written by a ParquetWriter
+    until they are drained. The position keeps counting across drains, because the
+    writer uses it to record column chunk offsets in the file footer."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_parquet(
+    df: pd.DataFrame,
+    fields: list,
+    geometry_encoding: str = "wkb",
+    batch_rows: int = PARQUET_BATCH_ROWS,
+):
+    """Serializes a dataframe to a single Parquet file, yielding the encoded bytes
+    as each row group of at most batch_rows rows is written."""
+
+    sink = ParquetSink()
+    writer = None
+    for start in range(0, max(len(df), 1), batch_rows):
+        batch = df.iloc[start : start + batch_rows]
+        table = arrow_table_from_dataframe(batch, fields, geometry_encoding)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema, compression="snappy")
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+class LoadPart:
+    """A slice of a dataframe that will be loaded by a single job. Iterating the part
+    serializes its rows into encoded chunks, and because each iteration starts over,
+    a failed job can be retried with the same part."""
+
+    def __init__(self, df: pd.DataFrame, serializer=iter_ndjson):
+        self.df = df
+        self.serializer = serializer
+
+    def __len__(self):
+        return len(self.df)
+
+    def __iter__(self):
+        return iter(self.serializer(self.df))
+
+
+def iter_parts(df: pd.DataFrame, chunk_size: int = None, serializer=iter_ndjson):
+    """Splits a dataframe into parts of at most chunk_size rows, each of which will
+    be loaded by its own job. Rows are only serialized as the load job reads them.
+    An empty dataframe has no parts, so no load jobs are run for it."""
+
+    if len(df) == 0:
+        return
+    chunk_size = chunk_size or len(df)
+    for start in range(0, len(df), chunk_size):
+        yield LoadPart(df.iloc[start : start + chunk_size], serializer=serializer)
+
+
+def get_serializer(fields: list, source_format: str, geometry_encoding: str = "wkb"):
+    """Returns the function used to serialize a dataframe to encoded chunks in the
+    provided load job source format."""
+
+    if source_format == "PARQUET":
+        return partial(iter_parquet, fields=fields, geometry_encoding=geometry_encoding)
+    return iter_ndjson
+
+
+def hash_rows(df: pd.DataFrame, key: str = "HEROP_ID") -> pd.DataFrame:
+    """Returns a dataframe with the key column of the input and a hash of all other
+    column values in each row. Columns are sorted by name before hashing, so the
+    hash doesn't depend on column order in the source file."""
+
+    columns = sorted([i for i in df.columns if i != key])
+    hashes = pd.util.hash_pandas_object(df[columns], index=False)
+    return pd.DataFrame({key: df[key].to_numpy(), ROW_HASH_COLUMN: hashes.to_numpy()})
+
+
+def diff_rows(
+    previous: pd.DataFrame, current: pd.DataFrame, key: str = "HEROP_ID"
+) -> dict:
+    """Compares two sets of row hashes (see hash_rows()), and returns the keys
+    of all inserted, changed, and deleted rows."""
+
+    merged = previous.merge(
+        current, on=key, how="outer", suffixes=("_prev", ""), indicator=True
+    )
+    both = merged["_merge"] == "both"
+    changed = both & (merged[ROW_HASH_COLUMN + "_prev"] != merged[ROW_HASH_COLUMN])
+    return {
+        "inserted": merged.loc[merged["_merge"] == "right_only", key].tolist(),
+        "changed": merged.loc[changed, key].tolist(),
+        "deleted": merged.loc[merged["_merge"] == "left_only", key].tolist(),
+    }
+
+
+def get_snapshot_path(name: str) -> Path:
+    return Path(BIGQUERY_CACHE_DIR, "snapshots", f"{name}.parquet")
+
+
+def read_snapshot(name: str):
+    """Returns the row hashes from the last load of a resource, or None."""
+
+    path = get_snapshot_path(name)
+    return pd.read_parquet(path) if path.is_file() else None
+
+
+def write_snapshot(name: str, row_hashes: pd.DataFrame):
+    path = get_snapshot_path(name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    row_hashes.to_parquet(path, index=False)
+
+
+class ChunkedReader(io.RawIOBase):
+    """Read-only file-like object over an iterable of encoded byte chunks. This
+    allows a generator to be passed as file_obj to Client.load_table_from_file(),
+    which will then read from it in fixed-size pieces during the upload.
+
+    The bytes returned by the last read are kept, so that the upload can seek back
+    into them. A resumable upload does this when a chunk fails, to send it again
+    from the last byte the server received."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+        self._position = 0
+        self._last = b""
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # only positions within the last read can be returned to, anything earlier
+        # would require rewinding the chunks.
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("ChunkedReader can't seek from the end")
+        start = self._position - len(self._last)
+        if not start <= offset <= self._position:
+            raise io.UnsupportedOperation(
+                f"ChunkedReader can't seek to {offset} (last read started at {start})"
+            )
+
+        # the bytes after the new position are read again before any new chunks
+        self._buffer[:0] = self._last[offset - start :]
+        self._last = self._last[: offset - start]
+        self._position = offset
+        return self._position
+
+    def read(self, size=-1):
+        # keep pulling chunks until the requested size is available, because the
+        # upload treats any short read as the end of the stream.
+        while size is None or size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer.extend(next(self._chunks))
+            except StopIteration:
+                break
+        if size is None or size < 0:
+            size = len(self._buffer)
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        self._last = data
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+
+def read_resource(
+    data_resource: dict, geometry_precision: int = None, repair_geometry: bool = True
+):
+    """Reads all data from the file indicated in the provided schema, and performs
+    some data validation and cleaning along the way. For shapefiles, geometries are
+    checked and cleaned with check_geometry(), using the precision and repair
+    arguments, and any problems that were found are included in the errors.
+
+    Returns a dataframe (None if the file could not be read), a list of error
+    messages, and the per-column coercion report from coerce_dataframe()."""
+
+    errors = []
+
+    dataset_path = data_resource["path"]
+
+    # get the format, assume CSV if not present
+    format = data_resource.get("format", "csv")
+
+    if format not in ["csv", "shp"]:
+        errors.append(f"Invalid dataset format: {format}")
+        return None, errors, {}
+
+    try:
+        if format == "shp":
+            if isinstance(dataset_path, list):
+                dataset_path = [i for i in dataset_path if i.endswith(".shp")][0]
+                df = gpd.read_file(dataset_path)
+            elif dataset_path.endswith(".zip"):
+                if dataset_path.startswith("http"):
+                    dataset_path = f"/vsizip/vsicurl/{dataset_path}"
+                df = gpd.read_file(dataset_path)
+        elif format == "csv":
+            df = pd.read_csv(dataset_path, dtype="object")
+
+    except Exception as e:
+        errors.append(f"error reading file: {str(e)}")
+        return None, errors, {}
+
+    field_names = [i["name"] for i in data_resource["schema"]["fields"]]
+
+    # the geometry column is loaded to the "geom" field added in create_table()
+    if format == "shp":
+        df = df.rename_geometry("geom")
+        field_names.append("geom")
+        df["geom"], geometry_report = check_geometry(
+            df["geom"],
+            ids=df["HEROP_ID"] if "HEROP_ID" in df.columns else None,
+            precision=geometry_precision,
+            repair=repair_geometry,
+        )
+        errors += format_geometry_report(geometry_report)
+
+    # remove any input columns that are not in the schema
+    drop_columns = [i for i in df.columns if i not in field_names]
+    if drop_columns:
+        errors.append(
+            f"{len(drop_columns)} source columns missing from schema: "
+            + ", ".join(drop_columns)
+        )
+    df.drop(columns=drop_columns, inplace=True)
+
+    # check for schema columns that are not found in the source data
+    missing_columns = [i for i in field_names if i not in df.columns]
+    if missing_columns:
+        errors.append(
+            f"{len(missing_columns)} schema fields missing from source: "
+            + ", ".join(missing_columns)
+        )
+
+    # iterate fields and zfill columns where needed
+    for f in data_resource["schema"]["fields"]:
+        if f.get("zfill", False) is True and f["name"] in df.columns:
+            col = df[f["name"]]
+            df[f["name"]] = col.where(
+                col.isna(), col.astype(str).str.zfill(f["max_length"])
+            )
+
+    # cast all columns to the types defined in the schema. this happens one column
+    # at a time, and the report holds per-column counts of coerced/nulled values.
+    df, report = coerce_dataframe(df, data_resource["schema"]["fields"])
+    for col, counts in report.items():
+        if counts["invalid"]:
+            errors.append(
+                f"{counts['invalid']} values in {col} could not be cast to "
+                f"{counts['type']}, set to null"
+            )
+
+    return df, errors, report
+
+
+def localize_resource(data_resource: dict, directory: Path = None):
+    """Fetches the source file(s) of a resource into a local directory, and returns a
+    copy of the resource that points to the local file(s), along with a sha256 hash
+    of all source bytes.
+
+    Remote files are fetched with download_file(), which revalidates a cached copy
+    with the server and only downloads it again if it has changed. HTTP errors are
+    raised, so stale or missing files are never fingerprinted. Local files are
+    copied through a temporary file, so an interrupted copy is never used."""
+
+    if not directory:
+        directory = Path(BIGQUERY_CACHE_DIR, "sources", data_resource["name"])
+    directory.mkdir(parents=True, exist_ok=True)
+
+    paths = data_resource["path"]
+    if not isinstance(paths, list):
+        paths = [paths]
+
+    local_paths = []
+    for path in paths:
+        out_path = Path(directory, path.split("/")[-1])
+        if path.startswith("http"):
+            download_file(path, out_path, no_cache=True)
+        else:
+            part_path = Path(f"{out_path}.part")
+            shutil.copyfile(path, part_path)
+            part_path.replace(out_path)
+        local_paths.append(out_path)
+
+    digest = hashlib.sha256()
+    for path in sorted(local_paths):
+        digest.update(hash_file(path).encode("utf-8"))
+
+    local_resource = dict(data_resource)
+    if isinstance(data_resource["path"], list):
+        local_resource["path"] = [str(i) for i in local_paths]
+    else:
+        local_resource["path"] = str(local_paths[0])
+
+    return local_resource, digest.hexdigest()
+
+
+def get_schema_fields(data_resource: dict) -> list:
+    """Returns the BigQuery table schema for a data resource, as a list of
+    SchemaFields."""
+
+    field_list = []
+    for f in data_resource["schema"]["fields"]:
+        max_length = f.get("max_length")
+        field_list.append(
+            SchemaField(
+                name=f["name"],
+                field_type=BQ_TYPE_LOOKUP[f["type"]],
+                max_length=max_length,
+            )
+        )
+
+    # if loading a shapefile, create and extra field for the geometry
+    if data_resource["format"] == "shp":
+        field_list.append(
+            SchemaField(
+                name="geom",
+                field_type="GEOGRAPHY",
+            )
+        )
+
+    return field_list
+
+
+def get_partitioning(data_resource: dict, field_types: dict):
+    """Builds the table partitioning defined by the bq_partitioning property of a
+    data resource. Two types are supported:
+
+        {"type": "range", "field": "year", "start": 1980, "end": 2030, "interval": 1}
+        {"type": "time", "field": "date", "unit": "YEAR"}
+
+    Range partitioning needs an INTEGER field, and time partitioning a DATE field.
+    Returns a (RangePartitioning, TimePartitioning) tuple, where at most one is set."""
+
+    config = data_resource.get("bq_partitioning")
+    if not config:
+        return None, None
+
+    field = config["field"]
+    if config["type"] == "range":
+        if field_types.get(field) != "INTEGER":
+            raise ValueError(f"range partitioning field must be an integer: {field}")
+        return (
+            RangePartitioning(
+                field=field,
+                range_=PartitionRange(
+                    start=config["start"],
+                    end=config["end"],
+                    interval=config.get("interval", 1),
+                ),
+            ),
+            None,
+        )
+    if config["type"] == "time":
+        if field_types.get(field) != "DATE":
+            raise ValueError(f"time partitioning field must be a date: {field}")
+        return None, TimePartitioning(type_=config.get("unit", "YEAR"), field=field)
+
+    raise ValueError(f"Invalid partitioning type: {config['type']}")
+
+
+def get_resource_fingerprint(
+    data_resource: dict, source_hash: str, options: dict = None
+) -> dict:
+    """Combines the hash of a resource's source bytes with a hash of its resolved
+    schema and destination, and a hash of the load options that change what is
+    written to the table. If any of these change, the resource needs to be
+    reloaded."""
+
+    schema_info = {
+        k: data_resource.get(k)
+        for k in [
+            "schema",
+            "format",
+            "bq_dataset_name",
+            "bq_table_name",
+            "bq_clustering_fields",
+            "bq_partitioning",
+        ]
+    }
+    return {
+        "source": source_hash,
+        "schema": hash_json(schema_info),
+        "options": hash_json(options or {}),
+    }
+
+
+class LoadManifest:
+    """Local record of each resource's fingerprint as of its last successful load,
+    stored as JSON. Resources whose fingerprints match the manifest can be skipped."""
+
+    def __init__(self, path: Path = Path(BIGQUERY_CACHE_DIR, "manifest.json")):
+        self.path = Path(path)
+        self.entries = load_json(self.path) if self.path.is_file() else {}
+        self._lock = threading.Lock()
+
+    def is_current(self, name: str, fingerprint: dict) -> bool:
+        entry = self.entries.get(name)
+        return entry is not None and entry["fingerprint"] == fingerprint
+
+    def record(self, name: str, fingerprint: dict, summary: dict):
+        """Add or update the entry for a resource, and write the manifest to disk."""
+
+        with self._lock:
+            self.entries[name] = {
+                "fingerprint": fingerprint,
+                "table": summary["table"],
+                "rows": summary["rows"],
+                "loaded": datetime.now().isoformat(),
+            }
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            write_json(self.entries, self.path)
+
+
+def geometry_to_wkb(batch: pa.RecordBatch, column: str = "geom") -> pa.RecordBatch:
+    """Replaces the WKT strings that BigQuery returns for a GEOGRAPHY column with
+    WKB, which GeoParquet and OGR writers expect."""
+
+    index = batch.schema.get_field_index(column)
+    wkb = shapely.to_wkb(
+        shapely.from_wkt(batch.column(index).to_numpy(zero_copy_only=False))
+    )
+    return batch.set_column(index, column, pa.array(wkb, type=pa.binary()))
+
+
+def write_csv_batches(batches, path: Path, first: pa.RecordBatch):
+    """Writes batches to CSV with pandas, so values are only quoted if they contain
+    a delimiter, quote, or line break, as in earlier exports. (pyarrow's CSV writer
+    quotes every string value.) Arrow dtypes keep nullable integers from being
+    written as floats."""
+
+    with open(path, "w", newline="") as f:
+        for n, batch in enumerate(batches):
+            df = batch.to_pandas(types_mapper=pd.ArrowDtype)
+            df.to_csv(f, index=False, header=n == 0)
+
+
+def write_parquet_batches(batches, path: Path, first: pa.RecordBatch):
+    """Writes batches to Parquet. If there is a geom column, it is written as WKB
+    with GeoParquet metadata, so that GIS software reads it as geometry."""
+
+    if "geom" in first.schema.names:
+        batches = (geometry_to_wkb(i) for i in batches)
+        metadata = {
+            "version": "1.0.0",
+            "primary_column": "geom",
+            "columns": {"geom": {"encoding": "WKB", "geometry_types": []}},
+        }
+        schema = geometry_to_wkb(first).schema.with_metadata(
+            {b"geo": json.dumps(metadata).encode("utf-8")}
+        )
+    else:
+        schema = first.schema
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch.replace_schema_metadata(schema.metadata))
+
+
+def write_ogr_batches(batches, path: Path, first: pa.RecordBatch, driver: str):
+    """Streams batches into a GDAL/OGR vector format (e.g. FlatGeobuf). OGR can't
+    create fields for BigQuery NUMERIC (38 digit decimal) columns, so these are
+    written as floats. Results without a geom column can't be written to these
+    formats, so raise a ValueError before the output file is created."""
+
+    if "geom" not in first.schema.names:
+        raise ValueError(
+            f"query results have no geom column, so they can't be written to "
+            f"{path.suffix}; export to .csv or .parquet instead"
+        )
+
+    def prepare(batch):
+        batch = geometry_to_wkb(batch)
+        for n, field in enumerate(batch.schema):
+            if pa.types.is_decimal(field.type):
+                column = batch.column(n).cast(pa.float64())
+                batch = batch.set_column(n, field.name, column)
+        return batch
+
+    schema = prepare(first).schema
+    reader = pa.RecordBatchReader.from_batches(schema, (prepare(i) for i in batches))
+    pyogrio.write_arrow(
+        reader,
+        path,
+        driver=driver,
+        geometry_name="geom",
+        geometry_type="Unknown",
+        crs="EPSG:4326",
+    )
+
+
+# functions that stream Arrow record batches to a file, keyed by file extension
+EXPORT_WRITERS = {
+    ".csv": write_csv_batches,
+    ".parquet": write_parquet_batches,
+    ".fgb": partial(write_ogr_batches, driver="FlatGeobuf"),
+    ".shp": partial(write_ogr_batches, driver="ESRI Shapefile"),
+}
+
+
+def write_batches(batches, path: Path, total: int = None, progress_bar: bool = True):
+    """Writes an iterable of Arrow record batches to a file as they arrive, with
+    the writer chosen by the file extension (see EXPORT_WRITERS). Only one batch is
+    held in memory at a time. Returns the number of rows written."""
+
+    path = Path(path)
+    writer = EXPORT_WRITERS.get(path.suffix)
+    if writer is None:
+        raise ValueError(f"Invalid output type: {path.suffix}")
+
+    batches = iter(batches)
+    first = next(batches, None)
+    if first is None:
+        return 0
+
+    rows = 0
+    progress = tqdm(total=total, unit="rows", unit_scale=True, disable=not progress_bar)
+
+    def counted():
+        nonlocal rows
+        for batch in chain([first], batches):
+            rows += batch.num_rows
+            progress.update(batch.num_rows)
+            yield batch
+
+    try:
+        writer(counted(), path, first)
+    finally:
+        progress.close()
+    return rows
+
+
+def find_full_scans(query_plan: list, dataset_name: str = "spatial") -> list:
+    """Returns the names of tables in a dataset that are read in full by a query,
+    i.e. a READ step in the query plan that has no WHERE substep. Full scans of
+    the spatial tables are expensive, because every geometry is read."""
+
+    tables = []
+    for stage in query_plan:
+        for step in stage.steps:
+            if step.kind != "READ":
+                continue
+            sources = [i for i in step.substeps if i.startswith("FROM ")]
+            if any([i.startswith("WHERE ") for i in step.substeps]):
+                continue
+            for source in sources:
+                table_id = source[len("FROM ") :].strip("`")
+                if f".{dataset_name}." in f".{table_id}":
+                    tables.append(table_id)
+    return tables
+
+
+def get_query_profile(query_job, estimated_bytes: int = None) -> dict:
+    """Collects the statistics and query plan stages of a finished query job."""
+
+    elapsed = None
+    if query_job.started and query_job.ended:
+        elapsed = (query_job.ended - query_job.started).total_seconds()
+    return {
+        "job_id": query_job.job_id,
+        "estimated_bytes_processed": estimated_bytes,
+        "total_bytes_processed": query_job.total_bytes_processed,
+        "total_bytes_billed": query_job.total_bytes_billed,
+        "slot_millis": query_job.slot_millis,
+        "cache_hit": query_job.cache_hit,
+        "elapsed_seconds": elapsed,
+        "full_scans": find_full_scans(query_job.query_plan or []),
+        "stages": [
+            {
+                "name": i.name,
+                "status": i.status,
+                "records_read": i.records_read,
+                "records_written": i.records_written,
+                "wait_ms_avg": i.wait_ms_avg,
+                "read_ms_avg": i.read_ms_avg,
+                "compute_ms_avg": i.compute_ms_avg,
+                "write_ms_avg": i.write_ms_avg,
+                "elapsed_ms": (i.end - i.start).total_seconds() * 1000
+                if i.start and i.end
+                else None,
+            }
+            for i in query_job.query_plan or []
+        ],
+    }
+
+
+def print_query_profile(profile: dict, format: str = "table"):
+    """Prints a profile from get_query_profile(), as a table or JSON."""
+
+    if format == "json":
+        print(json.dumps(profile, indent=2, default=str))
+        return
+
+    for k, v in profile.items():
+        if k not in ["stages", "full_scans"]:
+            print(f"{k}: {v}")
+
+    columns = [
+        "name",
+        "status",
+        "records_read",
+        "records_written",
+        "wait_ms_avg",
+        "read_ms_avg",
+        "compute_ms_avg",
+        "write_ms_avg",
+        "elapsed_ms",
+    ]
+    rows = [columns] + [[str(i[c]) for c in columns] for i in profile["stages"]]
+    widths = [max([len(r[n]) for r in rows]) for n in range(len(columns))]
+    print("\nQUERY PLAN")
+    for row in rows:
+        print("  ".join([v.ljust(widths[n]) for n, v in enumerate(row)]).rstrip())
+
+    for table_id in profile["full_scans"]:
+        print(f"WARNING: full table scan of {table_id}")
+
+
+def print_batches(batches):
+    """Prints the rows of Arrow record batches, with geometries shortened to their
+    type (e.g. "POLYGON")."""
+
+    n = 0
+    for batch in batches:
+        for row in batch.to_pylist():
+            if n == 0:
+                print(list(row.keys()))
+            clean_row = []
+            for k, v in row.items():
+                if k == "geom" and v is not None:
+                    v = v.split("(")[0]
+                clean_row.append(v)
+            print(clean_row)
+            n += 1
+
+
+def normalize_sql(sql: str) -> str:
+    """Strips comments and collapses whitespace, so that formatting changes to a
+    .sql file don't produce a different cache key."""
+
+    sql = re.sub(r"--[^\n]*", "", sql)
+    return " ".join(sql.split()).rstrip(";")
+
+
+class QueryCache:
+    """Local read-through cache of query results, stored as Parquet files in a
+    directory. Files are named by a key that should change whenever the results
+    would (see BigQuery.get_query_cache_key()). Once the directory holds more than
+    max_bytes, the least recently used files are deleted."""
+
+    def __init__(
+        self,
+        directory: Path = Path(BIGQUERY_CACHE_DIR, "queries"),
+        max_bytes: int = QUERY_CACHE_MAX_BYTES,
+    ):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+
+    def get(self, key: str):
+        """Returns the path to the cached results for a key, or None."""
+
+        path = Path(self.directory, f"{key}.parquet")
+        if not path.is_file():
+            return None
+        # bump the modified time, which is what eviction is based on
+        os.utime(path)
+        return path
+
+    def put(self, key: str, batches):
+        """Writes an iterable of Arrow record batches to the cache, and returns the
+        path to the new file. Returns None if there were no batches to write."""
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = Path(self.directory, f"{key}.parquet")
+        tmp_path = Path(self.directory, f"{key}.parquet.part")
+
+        writer = None
+        try:
+            for batch in batches:
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, batch.schema)
+                writer.write_batch(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            return None
+
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def evict(self):
+        """Deletes the least recently used files until the cache fits in max_bytes."""
+
+        files = sorted(
+            self.directory.glob("*.parquet"), key=lambda i: i.stat().st_mtime
+        )
+        total = sum([i.stat().st_size for i in files])
+        while files and total > self.max_bytes:
+            path = files.pop(0)
+            total -= path.stat().st_size
+            path.unlink()
+
+
 class BigQuery:
     def __init__(self, project_id=os.getenv("BQ_PROJECT_ID")):
         if not project_id:
@@ -99,223 +1135,404 @@ class BigQuery:
         self.project_id = project_id
         self.client = get_client()
         self.job_result = None
+        self.query_profile = None
 
     def create_table(self, schema, overwrite=False):
         # make sure the dataset exists
         self.client.create_dataset(schema["bq_dataset_name"], exists_ok=True)
 
-        field_list = []
-        for f in schema["schema"]["fields"]:
-            max_length = f.get("max_length")
-            field_list.append(
-                SchemaField(
-                    name=f["name"],
-                    field_type=BQ_TYPE_LOOKUP[f["type"]],
-                    max_length=max_length,
-                )
-            )
-
-        # if loading a shapefile, create and extra field for the geometry
-        if schema["format"] == "shp":
-            field_list.append(
-                SchemaField(
-                    name="geom",
-                    field_type="GEOGRAPHY",
-                )
-            )
+        field_list = get_schema_fields(schema)
 
         full_table_id = (
             f"{self.project_id}.{schema['bq_dataset_name']}.{schema['bq_table_name']}"
         )
+        table = Table(full_table_id, schema=field_list)
+
+        # clustering and partitioning let queries that filter on these fields
+        # (e.g. a state prefix of HEROP_ID) scan only part of the table
+        field_types = {i.name: i.field_type for i in field_list}
+        clustering_fields = schema.get("bq_clustering_fields")
+        if clustering_fields:
+            missing = [i for i in clustering_fields if i not in field_types]
+            if missing:
+                raise ValueError(f"clustering fields not in schema: {missing}")
+            table.clustering_fields = clustering_fields
+        table.range_partitioning, table.time_partitioning = get_partitioning(
+            schema, field_types
+        )
+
         if overwrite is True:
             self.client.delete_table(full_table_id, not_found_ok=True)
-        table = self.client.create_table(
-            Table(full_table_id, schema=field_list),
-        )
+        table = self.client.create_table(table)
         return table
 
-    def load_rows_from_resource(self, data_resource):
-        """Loads all data from the file indicated in the provided schema, and
-        performs some data validation and cleaning along the way.
-
-        Returns a list of serialized JSON strings, and a list of error messages"""
+    def table_exists(self, dataset_name, table_name) -> bool:
+        try:
+            self.client.get_table(f"{self.project_id}.{dataset_name}.{table_name}")
+            return True
+        except NotFound:
+            return False
+
+    def load_table(
+        self,
+        parts,
+        dataset_name,
+        table_name,
+        source_format: str = "PARQUET",
+        retries: int = 3,
+        backoff: float = 2.0,
+    ):
+        """
+        Takes an iterable of parts, each an iterable of encoded chunks in the provided
+        source format, and loads them into the provided table name and dataset. Every
+        part is streamed into its own load job, and all jobs append to the same table.
+
+        Jobs whose upload or load fails with a transient error are retried up to
+        `retries` times, waiting backoff * 2^n seconds in between. Each part gets a
+        job id up front, so that a retry can tell whether the job was already
+        created (e.g. if only the upload response or a status request failed). An
+        existing job is polled again instead of uploading the part a second time,
+        which would append its rows twice. The part is only uploaded again if no job
+        was created, or if the job failed, in which case it wrote no rows.
 
-        rows, errors = [], []
+        The schema for the rows must match the table schema, and the dataset and
+        table must both already exist.
 
-        dataset_path = data_resource["path"]
+        Returns the list of completed load jobs.
+        """
 
-        # get the format, assume CSV if not present
-        format = data_resource.get("format", "csv")
+        full_table_id = f"{self.project_id}.{dataset_name}.{table_name}"
+        table = self.client.get_table(full_table_id)
 
-        if format not in ["csv", "shp"]:
-            errors.append(f"Invalid dataset format: {format}")
-            return rows, errors
+        load_job_config = LoadJobConfig(source_format=source_format)
+        job_prefix = f"{table_name}_{uuid.uuid4().hex}"
+        load_jobs = []
+        for n, part in enumerate(parts, start=1):
+            job_id = f"{job_prefix}_{n}"
+            load_job = None
+            for attempt in range(retries + 1):
+                try:
+                    if load_job is None:
+                        load_job = self._submit_load_job(
+                            part, table, load_job_config, job_id
+                        )
+                    print(f"{table_name}: running job {n} now...")
+                    load_job.result()
+                    break
+                except RETRY_EXCEPTIONS as e:
+                    if attempt == retries:
+                        raise e
+                    wait = backoff * 2**attempt
+                    print(f"{table_name}: job {n} failed ({e}), retrying in {wait}s")
+                    time.sleep(wait)
+                    load_job = self._get_job(job_id, table.location)
+                    if load_job is not None and load_job.error_result:
+                        # the job ran and failed, so a new one must load the part
+                        load_job = None
+                        job_id = f"{job_prefix}_{n}_{attempt + 1}"
+                except Exception as e:
+                    if load_job is not None:
+                        print(f"Errors encountered: {len(load_job.errors or [])}")
+                        for error in load_job.errors or []:
+                            print(error)
+                    raise e
+            print(f"{table_name}: output rows: {load_job.output_rows}")
+            if load_job.errors:
+                print(f"Errors encountered: {len(load_job.errors)}")
+            load_jobs.append(load_job)
+
+        return load_jobs
+
+    def _submit_load_job(self, part, table, job_config, job_id):
+        """Uploads a part and creates its load job. If a job with this id already
+        exists, an earlier attempt created it (and only the response was lost), so
+        that job is returned instead."""
 
         try:
-            if format == "shp":
-                if isinstance(dataset_path, list):
-                    dataset_path = [i for i in dataset_path if i.endswith(".shp")][0]
-                    df = gpd.read_file(dataset_path)
-                elif dataset_path.endswith(".zip"):
-                    df = gpd.read_file(f"/vsizip/vsicurl/{dataset_path}")
-            elif format == "csv":
-                df = pd.read_csv(dataset_path, dtype="object")
-
-        except Exception as e:
-            errors.append(f"error reading file: {str(e)}")
-            return rows, errors
-
-        field_names = [i["name"] for i in data_resource["schema"]["fields"]]
-
-        # remove any input columns that are not in the schema
-        drop_columns = [i for i in df.columns if i not in field_names]
-        if drop_columns:
-            errors.append(
-                f"{len(drop_columns)} source columns missing from schema: "
-                + ", ".join(drop_columns)
-            )
-        df.drop(columns=drop_columns, inplace=True)
-
-        # check for schema columns that are not found in the source data
-        missing_columns = [i for i in field_names if i not in df.columns]
-        if missing_columns:
-            errors.append(
-                f"{len(missing_columns)} schema fields missing from source: "
-                + ", ".join(missing_columns)
+            return self.client.load_table_from_file(
+                file_obj=ChunkedReader(part),
+                destination=table,
+                job_config=job_config,
+                job_id=job_id,
             )
+        except Conflict:
+            return self.client.get_job(job_id, location=table.location)
 
-        # iterate fields and zfill columns where needed
-        for f in data_resource["schema"]["fields"]:
-            if f.get("zfill", False) is True:
-                df[f["name"]] = df[f["name"]].apply(
-                    lambda x: str(x).zfill(f["max_length"])
-                )
+    def _get_job(self, job_id, location=None):
+        """Returns the job with the provided id, or None if it was never created."""
 
-        field_types = {f["name"]: f["type"] for f in data_resource["schema"]["fields"]}
-        bq_field_types = {
-            f["name"]: BQ_TYPE_LOOKUP[f["type"]]
-            for f in data_resource["schema"]["fields"]
+        try:
+            job = self.client.get_job(job_id, location=location)
+        except NotFound:
+            return None
+        return job
+
+    def load_resource(
+        self,
+        data_resource,
+        overwrite: bool = False,
+        dry_run: bool = False,
+        chunk_size: int = None,
+        source_format: str = "PARQUET",
+        geometry_encoding: str = "wkb",
+        geometry_precision: int = None,
+        repair_geometry: bool = True,
+        retries: int = 3,
+        manifest: LoadManifest = None,
+        force: bool = False,
+        incremental: bool = False,
+    ):
+        """Runs the full load for a single data resource: read and validate the
+        source, create the table, and run the load job(s). Doesn't store anything
+        on this instance, so many resources can be loaded at once from different
+        threads.
+
+        If a manifest is provided, the source files are fetched locally and
+        fingerprinted first, along with the load options. If the fingerprint matches
+        the last successful load (and the table still exists), the resource is
+        skipped unless force or overwrite is True. Dry runs don't use the manifest.
+
+        If incremental=True, tabular resources are compared row by row (on their
+        primary key) with a local snapshot of the last load, and only inserted,
+        changed, and deleted rows are sent to BigQuery and applied with a MERGE.
+        When that isn't possible (no snapshot, no table, or a changed table schema)
+        the table is replaced with a full load.
+
+        Returns a summary dict for the resource."""
+
+        start = datetime.now()
+        summary = {
+            "name": data_resource["name"],
+            "table": f"{data_resource['bq_dataset_name']}.{data_resource['bq_table_name']}",
+            "warnings": [],
+            "coercion_report": {},
+            "jobs": 0,
+            "rows": 0,
+            "bytes": 0,
+            "elapsed": None,
+            "skipped": False,
+            "changes": None,
         }
 
-        # iterate the dataframe and turn each row into a dict that gets appened to rows.
-        # this list is later loaded as if it were a newline-delimited JSON file.
-        rows = []
-        for i in df.index:
-            row = {col: df.at[i, col] for col in df.columns if not col == "geom"}
-
-            # cast all values to strings for string fields. necessary because some
-            # NULL shapefile attribute values were interpreted as float('nan'), which
-            # breaks json parsing
-            for k in row:
-                val_str = str(row[k])
-                # test for float('nan') type, set to None
-                if val_str == "nan":
-                    row[k] = None
-                if "NA" in val_str:
-                    row[k] = None
-                # handle some infinite number variations
-                if "inf" in val_str.lower():
-                    row[k] = None
-                if row[k]:
-                    if field_types[k] == "string":
-                        row[k] = val_str
-                    if field_types[k] == "integer":
-                        try:
-                            row[k] = int(row[k])
-                        except ValueError:
-                            # special handle string values like '23493.3434'
-                            row[k] = int(round(float(row[k])))
-                    if field_types[k] == "number":
-                        row[k] = float(row[k])
-                    if field_types[k] == "boolean":
-                        if row[k] in [
-                            1,
-                            "1",
-                            "Yes",
-                            "YES",
-                            "yes",
-                            True,
-                            "True",
-                            "TRUE",
-                            "true",
-                        ]:
-                            row[k] = True
-                        elif row[k] in [
-                            0,
-                            "0",
-                            "No",
-                            "NO",
-                            "no",
-                            False,
-                            "False",
-                            "FALSE",
-                            "false",
-                        ]:
-                            row[k] = False
-                        else:
-                            row[k] = None
-                    if bq_field_types[k] == "DATE":
-                        try:
-                            val = datetime.strptime(row[k], "%m/%d/%Y").strftime(
-                                "%Y-%m-%d"
-                            )
-                            row[k] = val
-                        except Exception as e:
-                            raise e
-
-            # handle geometry column by dumping it to GeoJSON string. this fixes
-            # some Polygon format errors that occurred with the default WKT that
-            # GeoPandas returns for shapes. geom.__geo_interface__ is a shapely thing.
-            if "geom" in df.columns:
-                row["geom"] = json.dumps(df.at[i, "geom"].__geo_interface__)
-            try:
-                rows.append(json.dumps(row))
-            except Exception as e:
-                for k, v in row.items():
-                    print(field_types[k])
-                    print(k, v, type(v))
-                    print(isinstance(v, numpy.int64))
-                raise (e)
+        if dry_run:
+            manifest = None
+        if manifest is not None:
+            data_resource, source_hash = localize_resource(data_resource)
+            options = {
+                "source_format": source_format,
+                "geometry_encoding": geometry_encoding,
+                "geometry_precision": geometry_precision,
+                "repair_geometry": repair_geometry,
+            }
+            fingerprint = get_resource_fingerprint(data_resource, source_hash, options)
+            if (
+                not (force or overwrite)
+                and manifest.is_current(data_resource["name"], fingerprint)
+                and self.table_exists(
+                    data_resource["bq_dataset_name"], data_resource["bq_table_name"]
+                )
+            ):
+                summary["skipped"] = True
+                summary["elapsed"] = datetime.now() - start
+                return summary
 
-        return rows, errors
+        df, summary["warnings"], summary["coercion_report"] = read_resource(
+            data_resource, geometry_precision, repair_geometry
+        )
+        # fail before the table is touched, so an unreadable source never replaces it
+        if df is None:
+            raise Exception(
+                f"unable to read {data_resource['name']}: "
+                + "; ".join(summary["warnings"])
+            )
+        fields = data_resource["schema"]["fields"]
+        serializer = get_serializer(fields, source_format, geometry_encoding)
 
-    def load_table(self, rows, dataset_name, table_name):
-        """
-        Takes an input list of serialized json strings, each representing a table
-        row, and loads them into the provided table name and dataset.
+        # row hashes are only tracked for tabular resources with a primary key
+        key = data_resource["schema"].get("primaryKey")
+        row_hashes, changes = None, None
+        if data_resource.get("format", "csv") == "csv" and key in df.columns:
+            row_hashes = hash_rows(df, key)
+            if incremental and not overwrite:
+                changes = self._get_changes(data_resource, df, row_hashes, summary)
 
-        The schema for the rows must match the table schema, and the dataset and
-        table must both already exist.
-        """
+        if dry_run:
+            # still serialize every row, so that serialization errors are caught
+            parts = iter_parts(df, chunk_size=chunk_size, serializer=serializer)
+            summary["bytes"] = sum([len(c) for part in parts for c in part])
+            summary["changes"] = changes
+            summary["elapsed"] = datetime.now() - start
+            return summary
+
+        if changes is not None:
+            summary["changes"] = changes
+            load_jobs = self.merge_rows(
+                data_resource,
+                df,
+                changes,
+                chunk_size=chunk_size,
+                source_format=source_format,
+                geometry_encoding=geometry_encoding,
+                retries=retries,
+            )
+        else:
+            # if an incremental load wasn't possible the whole table is replaced
+            self.create_table(data_resource, overwrite=overwrite or incremental)
+            load_jobs = self.load_table(
+                iter_parts(df, chunk_size=chunk_size, serializer=serializer),
+                data_resource["bq_dataset_name"],
+                data_resource["bq_table_name"],
+                source_format=source_format,
+                retries=retries,
+            )
+        summary["jobs"] = len(load_jobs)
+        summary["rows"] = sum([i.output_rows or 0 for i in load_jobs])
+
+        if row_hashes is not None:
+            write_snapshot(data_resource["name"], row_hashes)
+        if manifest is not None:
+            manifest.record(data_resource["name"], fingerprint, summary)
+
+        summary["elapsed"] = datetime.now() - start
+        return summary
+
+    def _get_changes(self, data_resource, df, row_hashes, summary):
+        """Returns the row changes since the last load of a resource, or None if they
+        can't be applied incrementally. Reasons are added to the summary warnings."""
+
+        key = data_resource["schema"]["primaryKey"]
+        full_table_id = f"{self.project_id}.{summary['table']}"
+
+        previous = read_snapshot(data_resource["name"])
+        if previous is None:
+            summary["warnings"].append("no local snapshot, replacing the full table")
+            return None
+        if not df[key].is_unique:
+            summary["warnings"].append(
+                f"duplicate {key} values, replacing the full table"
+            )
+            return None
+        try:
+            table = self.client.get_table(full_table_id)
+        except NotFound:
+            return None
+
+        # a changed type or mode (e.g. INTEGER to FLOAT) can't be merged into the
+        # existing columns either, so every field property is compared
+        def describe(fields):
+            return [(i.name, i.field_type, i.mode, i.max_length) for i in fields]
+
+        if describe(table.schema) != describe(get_schema_fields(data_resource)):
+            summary["warnings"].append("table schema changed, replacing the full table")
+            return None
+
+        return diff_rows(previous, row_hashes, key)
+
+    def merge_rows(
+        self,
+        data_resource,
+        df,
+        changes,
+        chunk_size: int = None,
+        source_format: str = "PARQUET",
+        geometry_encoding: str = "wkb",
+        retries: int = 3,
+    ):
+        """Loads the inserted, changed, and deleted rows of a resource to a staging
+        table, and applies them to the resource's table with a single MERGE
+        statement. The staging table is deleted afterward.
+
+        Returns the list of load jobs for the staging table."""
+
+        key = data_resource["schema"]["primaryKey"]
+        upsert_keys = changes["inserted"] + changes["changed"]
+        if not upsert_keys and not changes["deleted"]:
+            return []
+
+        dataset_name = data_resource["bq_dataset_name"]
+        table_name = data_resource["bq_table_name"]
+        staging = dict(data_resource)
+        staging["bq_table_name"] = f"{table_name}__staging"
+        staging["schema"] = dict(data_resource["schema"])
+        staging["schema"]["fields"] = data_resource["schema"]["fields"] + [
+            CHANGE_TYPE_FIELD
+        ]
+
+        # deleted rows only need their key in the staging table
+        upserts = df[df[key].isin(upsert_keys)].assign(_change_type="upsert")
+        deletes = pd.DataFrame(
+            {
+                c: changes["deleted"] if c == key else None
+                for c in upserts.columns
+                if c != CHANGE_TYPE_FIELD["name"]
+            },
+            dtype=object,
+        ).assign(_change_type="delete")
+        staged = pd.concat([upserts, deletes], ignore_index=True)
+
+        self.create_table(staging, overwrite=True)
+        serializer = get_serializer(
+            staging["schema"]["fields"], source_format, geometry_encoding
+        )
+        load_jobs = self.load_table(
+            iter_parts(staged, chunk_size=chunk_size, serializer=serializer),
+            dataset_name,
+            staging["bq_table_name"],
+            source_format=source_format,
+            retries=retries,
+        )
+
+        columns = [c for c in df.columns]
+        target = f"`{self.project_id}.{dataset_name}.{table_name}`"
+        source = f"`{self.project_id}.{dataset_name}.{staging['bq_table_name']}`"
+        update = ", ".join([f"`{c}` = S.`{c}`" for c in columns if c != key])
+        insert = ", ".join([f"`{c}`" for c in columns])
+        values = ", ".join([f"S.`{c}`" for c in columns])
+        sql = f"""MERGE {target} T
+USING {source} S
+ON T.`{key}` = S.`{key}`
+WHEN MATCHED AND S._change_type = 'delete' THEN DELETE
+WHEN MATCHED THEN UPDATE SET {update}
+WHEN NOT MATCHED AND S._change_type != 'delete' THEN INSERT ({insert}) VALUES ({values})"""
+        print(
+            f"{table_name}: merging {len(upsert_keys)} upserts, {len(changes['deleted'])} deletes"
+        )
+        try:
+            self.client.query(sql).result()
+        finally:
+            self.client.delete_table(
+                f"{self.project_id}.{dataset_name}.{staging['bq_table_name']}",
+                not_found_ok=True,
+            )
 
-        print(f"Input rows: {len(rows)}")
+        return load_jobs
 
-        str_data = "\n".join(rows)
-        data_as_file = io.StringIO(str_data)
+    def get_query_cache_key(self, sql: str) -> str:
+        """Returns a key for the results of a query, based on the normalized SQL and
+        the last modified time of every table it references. The referenced tables
+        are found with a dry run, which is free and uses no slots."""
 
-        full_table_id = f"{self.project_id}.{dataset_name}.{table_name}"
-        table = self.client.get_table(full_table_id)
+        job_config = QueryJobConfig(dry_run=True, use_query_cache=False)
+        query_job = self.client.query(sql, job_config=job_config)
+        tables = {}
+        for ref in query_job.referenced_tables:
+            table_id = f"{ref.project}.{ref.dataset_id}.{ref.table_id}"
+            tables[table_id] = self.client.get_table(table_id).modified
+        return hash_json({"sql": normalize_sql(sql), "tables": tables})
 
-        load_job_config = LoadJobConfig(source_format="NEWLINE_DELIMITED_JSON")
-        load_job = self.client.load_table_from_file(
-            file_obj=data_as_file, destination=table, job_config=load_job_config
-        )
-        print("Running job now...")
-        try:
-            load_job.result()
-        except Exception as e:
-            print(f"Errors encountered: {len(load_job.errors)}")
-            for error in load_job.errors:
-                print(error)
-            raise e
-        print(f"Output rows: {load_job.output_rows}")
-        if load_job.errors:
-            print(f"Errors encountered: {len(load_job.errors)}")
-        return load_job
-
-    def run_query_from_file(self, path, dry_run=False):
+    def run_query_from_file(
+        self, path, dry_run=False, cache: QueryCache = None, profile: bool = False
+    ):
         """Reads a query statement from a .sql file and performs the query on BQ.
         If dry_run is true, just print the query and don't perform it.
+
+        If a cache is provided, results are read from it when none of the tables in
+        the query have changed since they were cached. Otherwise, the results are
+        written to the cache as they are downloaded.
+
+        If profile is true, the bytes the query will process are estimated with a
+        dry run, and the query always runs on BQ (the cache isn't read). The job
+        statistics and query plan are stored in self.query_profile.
         """
 
         with open(path, "r") as o:
@@ -326,30 +1543,73 @@ class BigQuery:
         if dry_run:
             return
 
+        if cache is not None:
+            key = self.get_query_cache_key(sql)
+            cached = cache.get(key)
+            if cached and not profile:
+                print(f"using cached results: {cached}")
+                self.job_result = pq.ParquetFile(cached)
+                return self.job_result
+
+        if profile:
+            job_config = QueryJobConfig(dry_run=True, use_query_cache=False)
+            estimate = self.client.query(sql, job_config=job_config)
+
         query_job = self.client.query(sql)
         result = query_job.result()
 
         self.job_result = result
 
-        return result
+        if profile:
+            self.query_profile = get_query_profile(
+                query_job, estimate.total_bytes_processed
+            )
+
+        if cache is not None:
+            cached = cache.put(key, result.to_arrow_iterable())
+            if cached:
+                self.job_result = pq.ParquetFile(cached)
+
+        return self.job_result
 
-    def export_results(self, path):
-        """Exports the latest results from a query job."""
+    def iter_result_batches(self):
+        """Yields the latest results as Arrow record batches, either from the local
+        cache or from the query job. Geography values are WKT strings."""
+
+        if isinstance(self.job_result, pq.ParquetFile):
+            yield from self.job_result.iter_batches()
+        else:
+            yield from self.job_result.to_arrow_iterable()
+
+    def export_results(self, path, progress_bar: bool = True):
+        """Exports the latest results from a query job. Result pages are written as
+        they are downloaded (see write_batches()), so exports run in constant memory.
+        Supported outputs are .csv, .parquet (GeoParquet), .fgb, and .shp."""
 
         if not self.job_result:
             print("No results to export")
+            return
 
-        if path.endswith(".csv"):
-            df = self.job_result.to_dataframe()
-            print(df.columns)
-            df.to_csv(path, index=False)
-
-        elif path.endswith(".shp"):
-            df = self.job_result.to_geodataframe()
-            df.to_file(path)
+        if Path(path).suffix not in EXPORT_WRITERS:
+            print(
+                "Invalid output type. Must be file ending in "
+                + ", ".join(EXPORT_WRITERS.keys())
+            )
+            return
 
+        if isinstance(self.job_result, pq.ParquetFile):
+            total = self.job_result.metadata.num_rows
         else:
-            print("Invalid output type. Must be file ending in .csv or .shp.")
+            total = self.job_result.total_rows
+
+        start = datetime.now()
+        rows = write_batches(
+            self.iter_result_batches(), path, total=total, progress_bar=progress_bar
+        )
+        if rows == 0:
+            print("No results to export")
+            return
+        print(f"{rows} rows written to {path} in {datetime.now() - start}")
 
     def print_results(self):
         """Prints the latest results from a query job."""
@@ -358,15 +1618,7 @@ class BigQuery:
             print("No results")
             return
 
-        for n, row in enumerate(self.job_result):
-            if n == 0:
-                print(list(row.keys()))
-            clean_row = []
-            for k, v in row.items():
-                if k == "geom":
-                    v = v.split("(")[0]
-                clean_row.append(v)
-            print(clean_row)
+        print_batches(self.iter_result_batches())
 
     def generate_reference_doc(self, resources, outfile: Path):
         project_id = os.getenv("BQ_PROJECT_ID")
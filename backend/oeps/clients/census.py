@@ -1,15 +1,508 @@
+import os
+import itertools
 import json
+import queue
 import shutil
 import subprocess
+import threading
+import time
 import pandas as pd
 import geopandas as gpd
+import numpy
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from pathlib import Path
 
-from oeps.utils import download_file
+from oeps.utils import (
+    download_files,
+    hash_file,
+    hash_json,
+    load_json,
+    write_json,
+    DOWNLOAD_WORKERS,
+)
 from oeps.config import LOOKUPS_DIR, CACHE_DIR
+from oeps import geometry
+from oeps.geometry import (
+    check_geometry,
+    combine_geometry_reports,
+    format_geometry_report,
+)
 
 GEODATA_CACHE_DIR = Path(CACHE_DIR, "geodata")
 
+# changes to this module, or to the modules its cached pipeline stages call into,
+# invalidate all cached stages (see StageCache)
+CODE_VERSION = hash_json([hash_file(__file__), hash_file(geometry.__file__)])
+
+# generalization levels and their simplification tolerances, in degrees (all source
+# files are in EPSG:4269). The 5m and 20m tolerances approximate 0.2mm at 1:5,000,000
+# and 1:20,000,000, and screen is about one pixel at a national view (zoom 4).
+GENERALIZATION_LEVELS = {
+    "5m": 0.01,
+    "20m": 0.04,
+    "screen": 0.1,
+}
+
+# default number of distinct positions along each axis in TopoJSON output
+TOPOJSON_QUANTIZATION = 100000
+
+# properties that are kept in TopoJSON output
+TOPOJSON_FIELDS = ["HEROP_ID", "LABEL", "BBOX"]
+
+# source fields that are not included in the PMTiles vector tiles
+PMTILES_EXCLUDE_FIELDS = [
+    "STATEFP",
+    "COUNTYFP",
+    "COUNTYNS",
+    "TRACTCE",
+    "BLKGRPCE",
+    "STATENS",
+    "STATE",
+    "AFFGEOID",
+    "CENSUSAREA",
+    "GEOID",
+    "GEO_ID",
+    "STUSPS",
+    "NAME",
+    "LSAD",
+    "ALAND",
+    "AWATER",
+    "minx",
+    "miny",
+    "maxx",
+    "maxy",
+]
+
+
+def format_rounded(values: pd.Series, ndigits: int) -> pa.Array:
+    """Rounds floats and formats them as strings, producing exactly the same output as
+    f"{round(value, ndigits)}" for each value, but for a whole column at once.
+
+    numpy rounding only differs from Python's round() when a value is within a tiny
+    distance of a tie (e.g. 2.675), so only those values are rounded one by one. The
+    shortest repr of a float is the same in Arrow as in Python, except that whole
+    numbers have no trailing ".0"."""
+
+    values = values.to_numpy(dtype="float64", copy=True)
+    rounded = numpy.round(values, ndigits)
+    scaled = values * 10**ndigits
+    near_tie = numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6
+    rounded[near_tie] = [round(i, ndigits) for i in values[near_tie].tolist()]
+
+    strings = pa.array(rounded).cast(pa.string())
+    return pc.if_else(
+        pc.match_substring_regex(strings, "[.ein]"),
+        strings,
+        pc.binary_join_element_wise(strings, ".0", ""),
+    )
+
+
+def iter_geojson_features(df: gpd.GeoDataFrame, batch_rows: int = 10000):
+    """Serializes a GeoDataFrame to newline-delimited GeoJSON Features, yielding
+    utf-8 encoded chunks of at most batch_rows features. Properties and geometries
+    are each serialized for a whole batch at once."""
+
+    geometry_name = df.geometry.name
+    for start in range(0, len(df), batch_rows):
+        batch = df.iloc[start : start + batch_rows]
+        properties = pd.DataFrame(batch.drop(columns=geometry_name)).to_json(
+            orient="records", lines=True
+        )
+        geometries = shapely.to_geojson(batch.geometry.values)
+        lines = [
+            f'{{"type":"Feature","properties":{p},"geometry":{g or "null"}}}\n'
+            for p, g in zip(properties.splitlines(), geometries)
+        ]
+        yield "".join(lines).encode("utf-8")
+
+
+def to_topojson(
+    df: gpd.GeoDataFrame,
+    name: str,
+    quantization: int = TOPOJSON_QUANTIZATION,
+    fields: list = TOPOJSON_FIELDS,
+) -> dict:
+    """Encodes a GeoDataFrame of (multi)polygons as a quantized TopoJSON topology,
+    with one GeometryCollection object. Coordinates are snapped to a grid with
+    quantization positions along each axis, and each ring is cut into arcs at the
+    points where it meets other rings (junctions), so an edge shared by two
+    neighbors is stored once and referenced by both. Only the given fields are kept
+    as properties.
+
+    Rings that collapse to fewer than three positions after quantization are
+    dropped, and a feature with no rings left gets a null geometry."""
+
+    geometries = numpy.asarray(df.geometry.array, dtype=object)
+
+    # polygons > rings > coordinates, each with the index of its parent
+    parts, part_geometry = shapely.get_parts(geometries, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+
+    x0, y0, x1, y1 = shapely.total_bounds(geometries) if len(coords) else (0, 0, 0, 0)
+    kx = (x1 - x0) / (quantization - 1) or 1
+    ky = (y1 - y0) / (quantization - 1) or 1
+
+    # each grid position is stored as a single integer key
+    qx = numpy.round((coords[:, 0] - x0) / kx).astype("int64")
+    qy = numpy.round((coords[:, 1] - y0) / ky).astype("int64")
+    keys = qx * quantization + qy
+
+    # drop the closing position of each ring, and positions that are repeated
+    # after quantization
+    is_last = numpy.r_[coord_ring[1:] != coord_ring[:-1], True]
+    keys, coord_ring = keys[~is_last], coord_ring[~is_last]
+    is_repeat = numpy.r_[
+        False, (keys[1:] == keys[:-1]) & (coord_ring[1:] == coord_ring[:-1])
+    ]
+    keys, coord_ring = keys[~is_repeat], coord_ring[~is_repeat]
+    ring_index, starts, counts = numpy.unique(
+        coord_ring, return_index=True, return_counts=True
+    )
+    ends = starts + counts - 1
+    is_repeat = numpy.zeros(len(keys), dtype=bool)
+    is_repeat[ends[(keys[ends] == keys[starts]) & (counts > 1)]] = True
+    keys, coord_ring = keys[~is_repeat], coord_ring[~is_repeat]
+
+    ring_index, counts = numpy.unique(coord_ring, return_counts=True)
+    is_valid = numpy.isin(coord_ring, ring_index[counts >= 3])
+    keys, coord_ring = keys[is_valid], coord_ring[is_valid]
+    ring_index, starts, counts = numpy.unique(
+        coord_ring, return_index=True, return_counts=True
+    )
+
+    # a junction is a position that has different neighbors in different places,
+    # i.e. where a shared edge begins or ends
+    position = numpy.arange(len(keys))
+    ring_start = numpy.repeat(starts, counts)
+    ring_end = ring_start + numpy.repeat(counts, counts) - 1
+    previous = keys[numpy.where(position == ring_start, ring_end, position - 1)]
+    following = keys[numpy.where(position == ring_end, ring_start, position + 1)]
+    low = numpy.minimum(previous, following)
+    high = numpy.maximum(previous, following)
+    order = numpy.lexsort((high, low, keys))
+    sorted_keys, low, high = keys[order], low[order], high[order]
+    is_different = (sorted_keys[1:] == sorted_keys[:-1]) & (
+        (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+    )
+    is_junction = numpy.isin(keys, sorted_keys[1:][is_different])
+
+    arcs, arc_lookup = [], {}
+
+    def get_arc_index(arc):
+        if arc in arc_lookup:
+            return arc_lookup[arc]
+        if arc[::-1] in arc_lookup:
+            return ~arc_lookup[arc[::-1]]
+        arc_lookup[arc] = len(arcs)
+        arcs.append(arc)
+        return arc_lookup[arc]
+
+    # cut each ring into arcs, starting at its first junction. Rings without a
+    # junction start at their lowest key, so identical rings produce the same arc
+    ring_arcs = {}
+    key_list = keys.tolist()
+    junction_list = numpy.flatnonzero(is_junction).tolist()
+    first_junctions = numpy.searchsorted(junction_list, starts).tolist()
+    last_junctions = numpy.searchsorted(junction_list, starts + counts).tolist()
+    for ring, start, count, first_junction, last_junction in zip(
+        ring_index.tolist(),
+        starts.tolist(),
+        counts.tolist(),
+        first_junctions,
+        last_junctions,
+    ):
+        points = key_list[start : start + count]
+        junctions = [i - start for i in junction_list[first_junction:last_junction]]
+        first = junctions[0] if junctions else points.index(min(points))
+        points = points[first:] + points[:first] + [points[first]]
+        cuts = [i - first for i in junctions] if junctions else [0]
+        ring_arcs[ring] = [
+            get_arc_index(tuple(points[a : b + 1]))
+            for a, b in zip(cuts, cuts[1:] + [count])
+        ]
+
+    # the first ring of each polygon is its exterior
+    is_exterior = numpy.zeros(len(rings), dtype=bool)
+    is_exterior[numpy.unique(ring_part, return_index=True)[1]] = True
+    polygons = {}
+    for ring, arc_indices in ring_arcs.items():
+        part = ring_part[ring]
+        if is_exterior[ring]:
+            polygons[part] = [arc_indices]
+        elif part in polygons:
+            polygons[part].append(arc_indices)
+
+    geometry_polygons = [[] for i in range(len(df))]
+    for part, polygon in polygons.items():
+        geometry_polygons[part_geometry[part]].append(polygon)
+
+    properties = json.loads(
+        pd.DataFrame(df[[i for i in fields if i in df.columns]]).to_json(
+            orient="records"
+        )
+    )
+    is_multi = shapely.get_type_id(geometries) == 6
+    objects = []
+    for polygon_list, props, multi in zip(geometry_polygons, properties, is_multi):
+        if not polygon_list:
+            objects.append({"type": None, "properties": props})
+        elif len(polygon_list) == 1 and not multi:
+            objects.append(
+                {"type": "Polygon", "arcs": polygon_list[0], "properties": props}
+            )
+        else:
+            objects.append(
+                {"type": "MultiPolygon", "arcs": polygon_list, "properties": props}
+            )
+
+    # arc positions are delta-encoded from the previous position in the same arc
+    lengths = [len(i) for i in arcs]
+    flat = numpy.fromiter(
+        itertools.chain.from_iterable(arcs), dtype="int64", count=sum(lengths)
+    )
+    positions = numpy.stack(numpy.divmod(flat, quantization), axis=1)
+    deltas = numpy.diff(positions, axis=0, prepend=[[0, 0]])
+    arc_starts = numpy.cumsum([0] + lengths[:-1]).astype("int64")
+    deltas[arc_starts] = positions[arc_starts]
+    deltas = deltas.tolist()
+    encoded_arcs = [deltas[a : a + n] for a, n in zip(arc_starts.tolist(), lengths)]
+
+    return {
+        "type": "Topology",
+        "bbox": [float(x0), float(y0), float(x1), float(y1)],
+        "transform": {"scale": [kx, ky], "translate": [float(x0), float(y0)]},
+        "objects": {name: {"type": "GeometryCollection", "geometries": objects}},
+        "arcs": encoded_arcs,
+    }
+
+
+class GeoJSONSeqWriter:
+    """Writes GeoDataFrames to a binary file object as newline-delimited GeoJSON
+    features in EPSG:4326, dropping any of the exclude fields."""
+
+    def __init__(self, file, exclude=None):
+        self.file = file
+        self.exclude = exclude or []
+
+    def write(self, df: gpd.GeoDataFrame):
+        df = df.drop(columns=[i for i in self.exclude if i in df.columns])
+        df = df.to_crs("EPSG:4326")
+        for chunk in iter_geojson_features(df):
+            self.file.write(chunk)
+
+    def close(self):
+        self.file.close()
+
+
+class TippecanoeWriter(GeoJSONSeqWriter):
+    """Streams GeoDataFrames into the stdin of a tippecanoe process (see
+    CensusClient.get_tippecanoe_command()), without the PMTILES_EXCLUDE_FIELDS."""
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        super().__init__(self.process.stdin, exclude=PMTILES_EXCLUDE_FIELDS)
+
+    def write(self, df: gpd.GeoDataFrame):
+        # if tippecanoe exits early, the error is raised by close()
+        try:
+            super().write(df)
+        except BrokenPipeError:
+            pass
+
+    def close(self):
+        try:
+            super().close()
+        except BrokenPipeError:
+            pass
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.cmd)
+
+
+class GeoParquetWriter:
+    """Writes GeoDataFrames to a GeoParquet file, one or more row groups at a time.
+    Each table is cast to the schema of the first one."""
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def write(self, df: gpd.GeoDataFrame):
+        table = pa.table(df.to_arrow(index=False, geometry_encoding="WKB"))
+        if self.writer is None:
+            metadata = {
+                "version": "1.0.0",
+                "primary_column": "geometry",
+                "columns": {
+                    "geometry": {
+                        "encoding": "WKB",
+                        "geometry_types": [],
+                        "crs": df.crs.to_json_dict(),
+                    }
+                },
+            }
+            schema = table.schema.with_metadata(
+                {b"geo": json.dumps(metadata).encode("utf-8")}
+            )
+            self.writer = pq.ParquetWriter(self.path, schema, compression="zstd")
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class OGRStreamWriter:
+    """Writes GeoDataFrames into a single layer of a GDAL/OGR vector file. pyogrio
+    writes a whole layer in one call, and appending to a file (where the driver
+    supports it at all) rewrites it, so that call runs in a background thread and
+    reads Arrow batches from a queue as they are written. Each table is cast to
+    the schema of the first one."""
+
+    def __init__(self, path, driver, to_wgs84=False, **kwargs):
+        self.path = path
+        self.driver = driver
+        self.to_wgs84 = to_wgs84
+        self.kwargs = kwargs
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = None
+        self.schema = None
+        self.error = None
+
+    def _iter_batches(self):
+        while (table := self.queue.get()) is not None:
+            yield from table.to_batches()
+
+    def _write(self, reader, crs):
+        try:
+            pyogrio.write_arrow(
+                reader,
+                self.path,
+                driver=self.driver,
+                geometry_name="geometry",
+                geometry_type="Unknown",
+                crs=crs,
+                **self.kwargs,
+            )
+        except Exception as e:
+            self.error = e
+            # keep taking tables from the queue, so write() never blocks
+            while self.queue.get() is not None:
+                pass
+
+    def write(self, df: gpd.GeoDataFrame):
+        if self.to_wgs84:
+            df = df.to_crs("EPSG:4326")
+        table = pa.table(df.to_arrow(index=False, geometry_encoding="WKB"))
+        if self.thread is None:
+            self.schema = table.schema
+            reader = pa.RecordBatchReader.from_batches(
+                self.schema, self._iter_batches()
+            )
+            self.thread = threading.Thread(
+                target=self._write, args=(reader, df.crs.to_wkt()), daemon=True
+            )
+            self.thread.start()
+        if self.error:
+            raise self.error
+        self.queue.put(table.cast(self.schema))
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        if self.error:
+            raise self.error
+
+
+class StageCache:
+    """Local record of the fingerprint of each pipeline stage's inputs for one
+    geography/year/scale, as of the stage's last successful run, stored as JSON.
+    Intermediate dataframes are stored as GeoParquet next to the manifest, and
+    exports are recorded with their output path. Stages whose fingerprints match
+    the manifest (and whose output still exists) can be skipped."""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.path = Path(self.directory, "manifest.json")
+        self.entries = load_json(self.path) if self.path.is_file() else {}
+
+    def is_current(self, name: str, fingerprint: dict) -> bool:
+        entry = self.entries.get(name)
+        return (
+            entry is not None
+            and entry["fingerprint"] == fingerprint
+            and Path(entry["path"]).exists()
+        )
+
+    def get_path(self, name: str) -> Path:
+        return Path(self.entries[name]["path"])
+
+    def record(self, name: str, fingerprint: dict, path: Path):
+        """Add or update the entry for a stage, and write the manifest to disk."""
+
+        self.entries[name] = {
+            "fingerprint": fingerprint,
+            "path": str(path),
+            "created": datetime.now().isoformat(),
+        }
+        self.directory.mkdir(parents=True, exist_ok=True)
+        write_json(self.entries, self.path)
+
+    def get_dataframe(self, name: str, fingerprint: dict):
+        """Returns the cached dataframe for a stage, or None if it is not current."""
+
+        if not self.is_current(name, fingerprint):
+            return None
+        return gpd.read_parquet(self.get_path(name))
+
+    def put_dataframe(self, name: str, fingerprint: dict, df: gpd.GeoDataFrame):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = Path(self.directory, f"{name}.parquet")
+        part_path = Path(self.directory, f"{name}.parquet.part")
+        df.to_parquet(part_path, index=False)
+        part_path.replace(path)
+        self.record(name, fingerprint, path)
+
+
+def read_arrow_table(path):
+    """Reads a vector file into an Arrow table, with geometries as GeoArrow WKB. This
+    is defined at the module level so it can be run in a process pool."""
+
+    meta, table = pyogrio.read_arrow(path)
+    return table
+
+
+def read_arrow_schema(path) -> pa.Schema:
+    """Returns the Arrow schema of a vector file (see read_arrow_table()), without
+    reading any features."""
+
+    meta, table = pyogrio.read_arrow(path, max_features=0)
+    return table.schema
+
+
+def conform_table(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Casts a table to the provided schema, e.g. one unified from several files
+    with pa.unify_schemas(). Fields that are missing from the table are added as
+    nulls, and fields that aren't in the schema are dropped."""
+
+    arrays = []
+    for field in schema:
+        if field.name in table.column_names:
+            arrays.append(table.column(field.name).cast(field.type))
+        else:
+            arrays.append(pa.nulls(table.num_rows, field.type))
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
 
 class CensusClient:
     def __init__(self, verbose=False):
@@ -19,10 +512,15 @@ class CensusClient:
         self.year = ""
         self.geography = ""
         self.scale = ""
+        self.level = ""
+        self.geometry_report = None
 
     @property
     def name_string(self):
-        return f"{self.geography}-{self.year}-{self.scale}"
+        name = f"{self.geography}-{self.year}-{self.scale}"
+        if self.level:
+            name += f"-{self.level}"
+        return name
 
     def load_lookups(self):
         if self.verbose:
@@ -35,7 +533,7 @@ class CensusClient:
 
         return lookups
 
-    def download_all_files(self, no_cache=False):
+    def download_all_files(self, no_cache=False, workers=DOWNLOAD_WORKERS):
         download_dir = Path(
             GEODATA_CACHE_DIR, self.geography, "raw", self.year, self.scale
         )
@@ -49,100 +547,165 @@ class CensusClient:
                 print(" -", i)
             print("downloading...")
 
-        out_paths = []
-        for url in download_urls:
-            filename = url.split("/")[-1]
-            outpath = Path(download_dir, filename)
-            out_path = download_file(
-                url,
-                outpath,
-                desc=f" - {filename}",
-                progress_bar=self.verbose,
-                no_cache=no_cache,
-            )
-            out_paths.append(out_path)
+        # files are fetched concurrently, through a shared connection pool
+        downloads = [
+            (url, Path(download_dir, url.split("/")[-1])) for url in download_urls
+        ]
+        out_paths = download_files(
+            downloads,
+            workers=workers,
+            desc=f" - {len(downloads)} files",
+            progress_bar=self.verbose,
+            no_cache=no_cache,
+        )
 
         return out_paths
 
-    def unzip_files(self, paths):
+    def get_shapefile_paths(self, paths):
+        """Returns GDAL /vsizip/ paths to the shapefile inside each downloaded zip,
+        so they can be read without extracting the archives."""
+
         shp_paths = []
         for p in paths:
-            name = p.name
-            shp_file = Path(p.parent, name.replace("zip", "shp"))
-            shutil.unpack_archive(p, p.parent)
-            shp_paths.append(shp_file)
+            shp_name = p.name.replace("zip", "shp")
+            shp_paths.append(f"/vsizip/{Path(p).absolute()}/{shp_name}")
 
         return shp_paths
 
-    def create_dataframe_from_files(self, paths):
-        df_list = []
-        for p in paths:
-            df = gpd.read_file(p)
-            df_list.append(df)
+    def create_dataframe_from_files(self, paths, workers=None):
+        """Reads all files into a single GeoDataFrame. Files are read into Arrow
+        tables in parallel across worker processes (one per CPU by default, or
+        sequentially in this process if workers=1), and the tables are concatenated
+        before a single conversion to a GeoDataFrame."""
 
-        if len(df_list) > 1:
-            out_df = gpd.GeoDataFrame(
-                pd.concat(df_list, ignore_index=True), crs=df_list[0].crs
-            )
+        if len(paths) == 0:
+            raise ValueError("no files to read, the download may have failed")
+
+        workers = min(workers or os.cpu_count(), len(paths))
+        if workers == 1:
+            tables = [read_arrow_table(p) for p in paths]
         else:
-            out_df = df_list[0]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                tables = list(executor.map(read_arrow_table, paths))
+
+        # the same field may have a different width (or type) in each file
+        table = pa.concat_tables(tables, promote_options="permissive")
+
+        return self.create_dataframe_from_table(table)
+
+    def create_dataframe_from_table(self, table: pa.Table):
+        # the CRS is carried over in the geometry column's GeoArrow metadata
+        out_df = gpd.GeoDataFrame.from_arrow(table)
+        out_df = out_df.rename_geometry("geometry")
 
         return out_df
 
+    def benchmark_read(self, paths, workers=None, repeat=1):
+        """Times create_dataframe_from_files() in parallel and sequentially, and the
+        previous approach of gpd.read_file() per file followed by pd.concat().
+        Returns the best time in seconds for each method, over repeat runs."""
+
+        def read_legacy(paths):
+            df_list = [gpd.read_file(p) for p in paths]
+            return gpd.GeoDataFrame(
+                pd.concat(df_list, ignore_index=True), crs=df_list[0].crs
+            )
+
+        methods = {
+            "legacy": read_legacy,
+            "sequential": lambda paths: self.create_dataframe_from_files(paths, 1),
+            "parallel": lambda paths: self.create_dataframe_from_files(paths, workers),
+        }
+        timings = {"files": len(paths)}
+        for name, method in methods.items():
+            times = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                df = method(paths)
+                times.append(time.perf_counter() - start)
+            timings[name] = min(times)
+        timings["rows"] = len(df)
+
+        return timings
+
     def add_herop_id_to_dataframe(self, df: pd.DataFrame):
         lvl = self.lookups["census-summary-levels"][self.geography]
         suffixes = self.lookups["census-sources"][self.year][self.scale][
             self.geography
         ]["herop_id_suffixes"]
 
-        df["HEROP_ID"] = df.apply(
-            lambda row: f"{lvl}US{''.join([row[i] for i in suffixes])}", axis=1
-        )
+        herop_id = f"{lvl}US" + df[suffixes[0]]
+        for col in suffixes[1:]:
+            herop_id = herop_id + df[col]
+        df["HEROP_ID"] = herop_id
 
         return df
 
     def add_bbox_to_dataframe(self, df: pd.DataFrame):
         df = pd.concat([df, df.bounds], axis=1)
 
-        def concat_bounds(row):
-            minx = round(row["minx"], 3)
-            miny = round(row["miny"], 3)
-            maxx = round(row["maxx"], 3)
-            maxy = round(row["maxy"], 3)
-            return f"{minx},{miny},{maxx},{maxy}"
-
-        df["BBOX"] = df.apply(concat_bounds, axis=1)
+        bounds = [format_rounded(df[i], 3) for i in ["minx", "miny", "maxx", "maxy"]]
+        bbox = pc.binary_join_element_wise(*bounds, ",")
+        df["BBOX"] = pd.Series(
+            bbox.to_numpy(zero_copy_only=False), index=df.index, dtype=object
+        )
 
         return df
 
+    def get_lsad_lookup(self):
+        """Returns a lookup of (lsad value, position) for every LSAD that changes a
+        label. A code (e.g. "06") can be used, or the value itself (e.g. "County"),
+        in which case the last entry with that value is used. Codes take precedence."""
+
+        lookup = {}
+        for k, v in self.lookups["census-lsad"].items():
+            lookup[v["value"]] = (v["value"], v["position"])
+        for k, v in self.lookups["census-lsad"].items():
+            lookup[k] = (v["value"], v["position"])
+
+        return {k: v for k, v in lookup.items() if k and v[1]}
+
     def add_label_to_dataframe(self, df: pd.DataFrame):
         name_field = self.lookups["census-sources"][self.year][self.scale][
             self.geography
         ]["name_field"]
 
-        def generate_label(row):
-            lsad = row.get("LSAD")
-            name = row.get(name_field)
-            if lsad:
-                position = None
-                if lsad in self.lookups["census-lsad"]:
-                    lsad_value = self.lookups["census-lsad"][lsad]["value"]
-                    position = self.lookups["census-lsad"][lsad]["position"]
-                else:
-                    for k, v in self.lookups["census-lsad"].items():
-                        if lsad == v["value"]:
-                            lsad_value = lsad
-                            position = v["position"]
+        label = df[name_field].astype(object)
+        if "LSAD" in df.columns:
+            lsad_lookup = self.get_lsad_lookup()
+            matches = df["LSAD"].map(lsad_lookup).dropna()
+            lsad_value = matches.str[0]
+            prefix = matches.str[1] == "prefix"
+            names = label[matches.index].map(str)
+
+            label[matches.index] = (names + " " + lsad_value).where(
+                ~prefix, lsad_value + " " + names
+            )
+
+        df["LABEL"] = label
+
+        return df
+
+    def check_geometries(self, df: gpd.GeoDataFrame):
+        """Checks, repairs, and orients all geometries at once, and finds duplicate
+        HEROP_IDs (see check_geometry()). The report is stored in
+        self.geometry_report."""
 
-                if position:
-                    if position == "prefix":
-                        name = f"{lsad_value} {name}"
-                    else:
-                        name = f"{name} {lsad_value}"
+        ids = df["HEROP_ID"] if "HEROP_ID" in df.columns else None
+        df = df.copy()
+        df.geometry, self.geometry_report = check_geometry(df.geometry, ids=ids)
+
+        return df
 
-            return name
+    def generalize_dataframe(self, df: gpd.GeoDataFrame, level: str):
+        """Returns a copy of the dataframe with simplified geometries for one of the
+        GENERALIZATION_LEVELS. The whole dataframe is simplified as a coverage, so
+        each edge shared by two neighboring features is simplified once and both
+        features keep the same edge, with no gaps or overlaps introduced."""
 
-        df["LABEL"] = df.apply(generate_label, axis=1)
+        tolerance = GENERALIZATION_LEVELS[level]
+        df = df.copy()
+        df.geometry = shapely.coverage_simplify(df.geometry.values, tolerance)
 
         return df
 
@@ -179,70 +742,388 @@ class CensusClient:
 
         return outfile
 
-    def export_to_pmtiles(self, geojson_path, tippecanoe_path, output_dir=None):
+    def export_to_topojson(
+        self, df: pd.DataFrame, output_dir=None, quantization=TOPOJSON_QUANTIZATION
+    ):
+        """Writes a quantized TopoJSON file with only the TOPOJSON_FIELDS as
+        properties, see to_topojson()."""
+
         if not output_dir:
             output_dir = Path(GEODATA_CACHE_DIR, self.geography, "processed")
         output_dir.mkdir(exist_ok=True, parents=True)
 
-        outfile_pmtiles = Path(output_dir, f"{self.name_string}.pmtiles")
-        cmd = [
-            tippecanoe_path,
+        df = df.to_crs("EPSG:4326")
+        outfile = Path(output_dir, f"{self.name_string}.topojson")
+        topology = to_topojson(df, self.name_string, quantization)
+        with open(outfile, "w") as o:
+            json.dump(topology, o, separators=(",", ":"))
+
+        return outfile
+
+    def export_to_geoparquet(self, df: pd.DataFrame, output_dir=None):
+        if not output_dir:
+            output_dir = Path(GEODATA_CACHE_DIR, self.geography, "processed")
+        output_dir.mkdir(exist_ok=True, parents=True)
+
+        outfile = Path(output_dir, f"{self.name_string}.parquet")
+        df.to_parquet(outfile, index=False, compression="zstd")
+
+        return outfile
+
+    def export_to_fgb(self, df: pd.DataFrame, output_dir=None):
+        """Writes a FlatGeobuf file with a spatial index, which allows clients to
+        read only the features in a bbox, e.g. with HTTP range requests."""
+
+        if not output_dir:
+            output_dir = Path(GEODATA_CACHE_DIR, self.geography, "processed")
+        output_dir.mkdir(exist_ok=True, parents=True)
+
+        outfile = Path(output_dir, f"{self.name_string}.fgb")
+        df.to_file(outfile, driver="FlatGeobuf", engine="pyogrio", SPATIAL_INDEX="YES")
+
+        return outfile
+
+    def export_to_geojsonseq(self, df: pd.DataFrame, output_dir=None):
+        """Writes newline-delimited GeoJSON (GeoJSONSeq), one feature per line."""
+
+        if not output_dir:
+            output_dir = Path(GEODATA_CACHE_DIR, self.geography, "processed")
+        output_dir.mkdir(exist_ok=True, parents=True)
+
+        outfile = Path(output_dir, f"{self.name_string}.geojsonl")
+        writer = GeoJSONSeqWriter(open(outfile, "wb"))
+        writer.write(df)
+        writer.close()
+
+        return outfile
+
+    def get_tippecanoe_command(self, tippecanoe_path, outfile):
+        """Returns the tippecanoe command that reads newline-delimited GeoJSON
+        features from stdin and writes outfile."""
+
+        return [
+            str(tippecanoe_path),
             # "-zg",
             # tried a lot of zoom level directives, and seems like for block group
             # (which I believe is the densest)shp_paths 10 is needed to preserve shapes well enough.
             "-z10",
-            "-x",
-            "STATEFP",
-            "-x",
-            "COUNTYFP",
-            "-x",
-            "COUNTYNS",
-            "-x",
-            "TRACTCE",
-            "-x",
-            "BLKGRPCE",
-            "-x",
-            "STATENS",
-            "-x",
-            "STATE",
-            "-x",
-            "AFFGEOID",
-            "-x",
-            "CENSUSAREA",
-            "-x",
-            "GEOID",
-            "-x",
-            "GEO_ID",
-            "-x",
-            "STUSPS",
-            "-x",
-            "NAME",
-            "-x",
-            "LSAD",
-            "-x",
-            "ALAND",
-            "-x",
-            "AWATER",
-            "-x",
-            "minx",
-            "-x",
-            "miny",
-            "-x",
-            "maxx",
-            "-x",
-            "maxy",
+            # features are written one per line, so they can be parsed in parallel
+            "-P",
             "--no-simplification-of-shared-nodes",
             "--coalesce-densest-as-needed",
             "--extend-zooms-if-still-dropping",
             "--projection",
             "EPSG:4326",
             "-o",
-            str(outfile_pmtiles),
+            str(outfile),
             "-l",
             f"{self.name_string}",
             "--force",
-            str(geojson_path),
         ]
-        subprocess.run(cmd)
+
+    def export_to_pmtiles(self, df: pd.DataFrame, tippecanoe_path, output_dir=None):
+        """Streams the features as newline-delimited GeoJSON into tippecanoe's stdin,
+        so no intermediate GeoJSON file is written. Excluded fields are dropped
+        here, instead of passing -x to tippecanoe."""
+
+        if not output_dir:
+            output_dir = Path(GEODATA_CACHE_DIR, self.geography, "processed")
+        output_dir.mkdir(exist_ok=True, parents=True)
+
+        outfile_pmtiles = Path(output_dir, f"{self.name_string}.pmtiles")
+        writer = TippecanoeWriter(
+            self.get_tippecanoe_command(tippecanoe_path, outfile_pmtiles)
+        )
+        writer.write(df)
+        writer.close()
 
         return outfile_pmtiles
+
+    def stream_files_to_outputs(
+        self, paths, formats, output_dir=None, tippecanoe_path=None
+    ):
+        """An out-of-core alternative to create_dataframe_from_files() followed by
+        the export_to_*() methods. Each file is read, given HEROP_ID, BBOX, and
+        LABEL, and written to every output before the next file is read, so memory
+        use is bounded by the largest file rather than the whole country. Supports
+        shp, geoparquet, fgb, geojson, geojsonseq, and pmtiles formats. The
+        geometries in each file are checked and repaired with check_geometries(), and
+        the combined report is stored in self.geometry_report.
+
+        Returns a dict with the output path for each format."""
+
+        if not output_dir:
+            output_dir = Path(GEODATA_CACHE_DIR, self.geography, "processed")
+        output_dir.mkdir(exist_ok=True, parents=True)
+
+        # the same field may have a different width (or type) in each file, or be
+        # missing from some, so every file is cast to a schema unified from all of
+        # them. this is done before any writer starts, so a mismatch fails here
+        # instead of leaving truncated outputs.
+        schema = pa.unify_schemas(
+            [read_arrow_schema(p) for p in paths], promote_options="permissive"
+        )
+
+        outputs, writers = {}, {}
+        if "shp" in formats:
+            processed_dir = Path(output_dir, f"{self.name_string}-shp")
+            processed_dir.mkdir(parents=True, exist_ok=True)
+            outputs["shp"] = Path(f"{processed_dir}.zip")
+            writers["shp"] = OGRStreamWriter(
+                Path(processed_dir, f"{self.name_string}.shp"), "ESRI Shapefile"
+            )
+        if "geoparquet" in formats:
+            outputs["geoparquet"] = Path(output_dir, f"{self.name_string}.parquet")
+            writers["geoparquet"] = GeoParquetWriter(outputs["geoparquet"])
+        if "fgb" in formats:
+            outputs["fgb"] = Path(output_dir, f"{self.name_string}.fgb")
+            writers["fgb"] = OGRStreamWriter(
+                outputs["fgb"], "FlatGeobuf", SPATIAL_INDEX="YES"
+            )
+        if "geojson" in formats:
+            outputs["geojson"] = Path(output_dir, f"{self.name_string}.geojson")
+            writers["geojson"] = OGRStreamWriter(
+                outputs["geojson"], "GeoJSON", to_wgs84=True
+            )
+        if "geojsonseq" in formats:
+            outputs["geojsonseq"] = Path(output_dir, f"{self.name_string}.geojsonl")
+            writers["geojsonseq"] = GeoJSONSeqWriter(open(outputs["geojsonseq"], "wb"))
+        if "pmtiles" in formats:
+            outputs["pmtiles"] = Path(output_dir, f"{self.name_string}.pmtiles")
+            writers["pmtiles"] = TippecanoeWriter(
+                self.get_tippecanoe_command(tippecanoe_path, outputs["pmtiles"])
+            )
+
+        # ids are kept to find duplicates across files
+        reports, seen_ids = [], set()
+        try:
+            for path in paths:
+                if self.verbose:
+                    print(f"  {path}")
+                table = conform_table(read_arrow_table(path), schema)
+                df = self.create_dataframe_from_table(table)
+                df = self.add_herop_id_to_dataframe(df)
+                df = self.add_bbox_to_dataframe(df)
+                df = self.add_label_to_dataframe(df)
+                df = self.check_geometries(df)
+                ids = set(df["HEROP_ID"])
+                self.geometry_report["duplicate_ids"] += sorted(ids & seen_ids)
+                seen_ids |= ids
+                reports.append(self.geometry_report)
+                for writer in writers.values():
+                    writer.write(df)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        self.geometry_report = combine_geometry_reports(reports)
+
+        if "shp" in outputs:
+            shutil.make_archive(processed_dir, "zip", processed_dir)
+
+        return outputs
+
+
+def process_geography(
+    geography,
+    year,
+    scale,
+    formats,
+    destination=None,
+    tippecanoe_path=None,
+    no_cache=False,
+    download_workers=DOWNLOAD_WORKERS,
+    read_workers=None,
+    levels=None,
+    quantization=TOPOJSON_QUANTIZATION,
+    stream=False,
+    rebuild=False,
+    verbose=False,
+):
+    """Runs the full pipeline for one geography: download, read, add the derived
+    columns, and export to each format. Each of the generalization levels is then
+    exported to the same formats, with the level appended to the file names. With
+    stream=True, files are read and exported one at a time instead (see
+    CensusClient.stream_files_to_outputs()), and there are no generalized exports.
+    This is a module-level function so that geographies can be processed in separate
+    worker processes.
+
+    The output of each stage is cached (see StageCache), keyed by the hashes of the
+    source files, the lookups, and this module, so a rerun with the same inputs
+    only runs the exports that don't exist yet, starting from the last cached
+    dataframe. Use rebuild=True to run every stage again.
+
+    Returns a dict with the output paths (to be uploaded), the time in seconds
+    spent on each stage, and the geometry check report (if geometries were read in
+    this run). Skipped is True if there is no source configuration for this
+    geography/year combo."""
+
+    client = CensusClient(verbose=verbose)
+    client.year = year
+    client.geography = geography
+    client.scale = scale
+
+    result = {
+        "geography": geography,
+        "outputs": [],
+        "timings": {},
+        "geometry_report": None,
+        "skipped": False,
+    }
+
+    # skip if there isn't a config entry for this geography/year combo
+    if (
+        year not in client.lookups["census-sources"]
+        or geography not in client.lookups["census-sources"][year][scale]
+    ):
+        print(f"{geography}: no source configuration for this combo, skipping")
+        result["skipped"] = True
+        return result
+
+    start = time.perf_counter()
+
+    def finish_stage(name):
+        nonlocal start
+        now = time.perf_counter()
+        result["timings"][name] = now - start
+        start = now
+
+    print(f"{geography}: downloading files...")
+    paths = client.download_all_files(no_cache=no_cache, workers=download_workers)
+    finish_stage("download")
+
+    shp_paths = client.get_shapefile_paths(paths)
+
+    cache = StageCache(Path(GEODATA_CACHE_DIR, geography, "stages", f"{year}-{scale}"))
+    if rebuild:
+        cache.entries = {}
+
+    read_fingerprint = {
+        "sources": {p.name: hash_file(p) for p in paths},
+        "code": CODE_VERSION,
+    }
+    transform_fingerprint = {
+        "read": hash_json(read_fingerprint),
+        "lookups": hash_json(client.lookups),
+        "code": CODE_VERSION,
+    }
+
+    def get_export_fingerprint(format, level=""):
+        return {
+            "transform": hash_json(transform_fingerprint),
+            "format": format,
+            "level": level,
+            "destination": str(destination),
+            "quantization": quantization if format == "topojson" else None,
+        }
+
+    def use_cached_output(name, fingerprint):
+        if not cache.is_current(name, fingerprint):
+            return False
+        print(f"{geography}: using cached {name}")
+        result["outputs"].append(cache.get_path(name))
+        return True
+
+    def report_geometry_check():
+        result["geometry_report"] = client.geometry_report
+        for message in format_geometry_report(client.geometry_report):
+            print(f"{geography}: WARNING {message}")
+
+    if stream:
+        stream_formats = [
+            i for i in formats if not use_cached_output(i, get_export_fingerprint(i))
+        ]
+        if stream_formats:
+            print(
+                f"{geography}: streaming {len(shp_paths)} files to {', '.join(stream_formats)}..."
+            )
+            outputs = client.stream_files_to_outputs(
+                shp_paths, stream_formats, destination, tippecanoe_path
+            )
+            report_geometry_check()
+            for format, path in outputs.items():
+                cache.record(format, get_export_fingerprint(format), path)
+                result["outputs"].append(path)
+            finish_stage("stream")
+        return result
+
+    # dataframes are only read or computed when an export needs them, starting
+    # from the last stage whose inputs haven't changed
+    dataframes = {}
+
+    def get_dataframe(level=""):
+        if "transform" not in dataframes:
+            df = cache.get_dataframe("transform", transform_fingerprint)
+            if df is not None:
+                print(f"{geography}: using cached transform")
+                finish_stage("transform-cached")
+            else:
+                df = cache.get_dataframe("read", read_fingerprint)
+                if df is not None:
+                    print(f"{geography}: using cached read")
+                else:
+                    print(f"{geography}: creating dataframe...")
+                    df = client.create_dataframe_from_files(
+                        shp_paths, workers=read_workers
+                    )
+                    cache.put_dataframe("read", read_fingerprint, df)
+                finish_stage("read")
+
+                print(f"{geography}: add HEROP_ID, BBOX, LABEL...")
+                df = client.add_herop_id_to_dataframe(df)
+                df = client.add_bbox_to_dataframe(df)
+                df = client.add_label_to_dataframe(df)
+                finish_stage("transform")
+
+                print(f"{geography}: checking geometries...")
+                df = client.check_geometries(df)
+                report_geometry_check()
+                cache.put_dataframe("transform", transform_fingerprint, df)
+                finish_stage("check")
+            dataframes["transform"] = df
+
+        if level and level not in dataframes:
+            name = f"generalize-{level}"
+            fingerprint = {
+                "transform": hash_json(transform_fingerprint),
+                "tolerance": GENERALIZATION_LEVELS[level],
+            }
+            df = cache.get_dataframe(name, fingerprint)
+            if df is None:
+                print(f"{geography}: generalizing to {level}...")
+                df = client.generalize_dataframe(dataframes["transform"], level)
+                cache.put_dataframe(name, fingerprint, df)
+            finish_stage(name)
+            dataframes[level] = df
+
+        return dataframes[level or "transform"]
+
+    exporters = {
+        "shp": lambda df: client.export_to_shapefile(df, destination)["zipped"],
+        "geoparquet": lambda df: client.export_to_geoparquet(df, destination),
+        "fgb": lambda df: client.export_to_fgb(df, destination),
+        "geojson": lambda df: client.export_to_geojson(df, destination, overwrite=True),
+        "geojsonseq": lambda df: client.export_to_geojsonseq(df, destination),
+        "topojson": lambda df: client.export_to_topojson(df, destination, quantization),
+        "pmtiles": lambda df: client.export_to_pmtiles(
+            df, tippecanoe_path, destination
+        ),
+    }
+
+    for level in [""] + list(levels or []):
+        client.level = level
+        for format, exporter in exporters.items():
+            if format not in formats:
+                continue
+            name = format + (f"-{level}" if level else "")
+            fingerprint = get_export_fingerprint(format, level)
+            if use_cached_output(name, fingerprint):
+                continue
+            df = get_dataframe(level)
+            print(f"{geography}: generating {name}...")
+            path = exporter(df)
+            cache.record(name, fingerprint, path)
+            result["outputs"].append(path)
+            finish_stage(name)
+    client.level = ""
+
+    return result
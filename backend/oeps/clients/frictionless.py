@@ -51,6 +51,8 @@ class DataPackage:
             ## remove unneeded top-level attributes (outside of Data Package spec)
             res.pop("bq_table_name", None)
             res.pop("bq_dataset_name", None)
+            res.pop("bq_clustering_fields", None)
+            res.pop("bq_partitioning", None)
             res.pop("geodata_source", None)
             res.pop("explorer_config", None)
 
@@ -0,0 +1,170 @@
+import re
+from datetime import datetime
+from pathlib import Path
+
+import duckdb
+
+from oeps.config import CACHE_DIR
+from oeps.clients.bigquery import (
+    arrow_table_from_dataframe,
+    print_batches,
+    read_resource,
+    write_batches,
+    EXPORT_WRITERS,
+)
+
+LOCAL_DATABASE = Path(CACHE_DIR, "duckdb", "oeps.duckdb")
+
+# number of rows per Arrow record batch read from query results
+LOCAL_BATCH_ROWS = 50000
+
+# matches the table references in the SQL files, e.g. PROJECT_ID.spatial.states2018
+TABLE_REFERENCE = re.compile(r"PROJECT_ID\.(\w+)\.(\w+)")
+
+
+class LocalEngine:
+    """Runs the same PROJECT_ID-templated SQL as the BigQuery client, against an
+    embedded DuckDB database. Registry resources are stored as dataset.table (schema
+    and table in DuckDB), and PROJECT_ID is replaced with the name of the database,
+    so queries run unchanged. Resources referenced by a query are loaded the first
+    time they are needed, and geometries are stored with the spatial extension."""
+
+    def __init__(self, resources: list = None, database: Path = LOCAL_DATABASE):
+        self.database = Path(database)
+        self.database.parent.mkdir(parents=True, exist_ok=True)
+        self.catalog = self.database.stem
+        self.connection = duckdb.connect(str(self.database))
+        self.resources = {
+            (i["bq_dataset_name"], i["bq_table_name"]): i for i in resources or []
+        }
+        self.job_result = None
+        self.query_profile = None
+        self._spatial_loaded = False
+
+    def _load_spatial(self):
+        if not self._spatial_loaded:
+            self.connection.install_extension("spatial")
+            self.connection.load_extension("spatial")
+            self._spatial_loaded = True
+
+    def table_exists(self, dataset_name, table_name) -> bool:
+        result = self.connection.execute(
+            "SELECT count(*) FROM information_schema.tables "
+            "WHERE table_schema = ? AND table_name = ?",
+            [dataset_name, table_name],
+        ).fetchone()
+        return result[0] > 0
+
+    def load_resource(self, data_resource, overwrite: bool = False):
+        """Reads and validates a data resource (see read_resource()), and writes it to
+        a table with the same types that a BigQuery load would use. Shapefile
+        geometries are stored in a GEOMETRY column named geom.
+
+        Returns a list of warnings."""
+
+        dataset_name = data_resource["bq_dataset_name"]
+        table_name = data_resource["bq_table_name"]
+        if self.table_exists(dataset_name, table_name) and not overwrite:
+            return []
+
+        df, errors, report = read_resource(data_resource)
+        if df is None:
+            raise Exception(f"unable to read {data_resource['name']}: {errors}")
+        table = arrow_table_from_dataframe(df, data_resource["schema"]["fields"])
+
+        select = "*"
+        if "geom" in table.column_names:
+            self._load_spatial()
+            select = "* REPLACE (ST_GeomFromWKB(geom) AS geom)"
+
+        self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{dataset_name}"')
+        self.connection.register("source_table", table)
+        try:
+            self.connection.execute(
+                f'CREATE OR REPLACE TABLE "{dataset_name}"."{table_name}" AS '
+                f"SELECT {select} FROM source_table"
+            )
+        finally:
+            self.connection.unregister("source_table")
+
+        return errors
+
+    def load_referenced_tables(self, sql: str, overwrite: bool = False):
+        """Loads the registry resources for all tables referenced in the SQL, if they
+        are not in the database yet (or if overwrite=True)."""
+
+        for reference in sorted(set(TABLE_REFERENCE.findall(sql))):
+            resource = self.resources.get(reference)
+            if resource is None:
+                continue
+            if resource.get("format") == "shp":
+                self._load_spatial()
+            if overwrite or not self.table_exists(*reference):
+                print(f"loading {resource['name']} to {'.'.join(reference)}...")
+                start = datetime.now()
+                for e in self.load_resource(resource, overwrite=True):
+                    print("  " + e)
+                print(f"  done in {datetime.now() - start}")
+
+    def run_query_from_file(self, path, dry_run=False, overwrite: bool = False):
+        """Reads a query statement from a .sql file and performs the query locally.
+        If dry_run is true, just print the query and don't perform it. GEOMETRY
+        columns in the result are returned as WKT, the same as from BigQuery."""
+
+        with open(path, "r") as o:
+            content = o.read()
+        sql = content.replace("PROJECT_ID", self.catalog)
+        print(sql)
+
+        if dry_run:
+            return
+
+        self.load_referenced_tables(content, overwrite=overwrite)
+
+        relation = self.connection.sql(sql)
+        geom_columns = [
+            c for c, t in zip(relation.columns, relation.types) if str(t) == "GEOMETRY"
+        ]
+        if geom_columns:
+            replace = ", ".join([f'ST_AsText("{c}") AS "{c}"' for c in geom_columns])
+            relation = relation.project(f"* REPLACE ({replace})")
+
+        self.job_result = relation
+        return relation
+
+    def iter_result_batches(self):
+        """Yields the latest results as Arrow record batches."""
+
+        yield from self.job_result.to_arrow_reader(LOCAL_BATCH_ROWS)
+
+    def export_results(self, path, progress_bar: bool = True):
+        """Exports the latest results from a query (see BigQuery.export_results())."""
+
+        if self.job_result is None:
+            print("No results to export")
+            return
+
+        if Path(path).suffix not in EXPORT_WRITERS:
+            print(
+                "Invalid output type. Must be file ending in "
+                + ", ".join(EXPORT_WRITERS.keys())
+            )
+            return
+
+        start = datetime.now()
+        rows = write_batches(
+            self.iter_result_batches(), path, progress_bar=progress_bar
+        )
+        if rows == 0:
+            print("No results to export")
+            return
+        print(f"{rows} rows written to {path} in {datetime.now() - start}")
+
+    def print_results(self):
+        """Prints the latest results from a query."""
+
+        if self.job_result is None:
+            print("No results")
+            return
+
+        print_batches(self.iter_result_batches())
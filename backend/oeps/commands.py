@@ -1,16 +1,31 @@
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 from argparse import Namespace
 import subprocess
+import time
 
 import click
 from flask.cli import AppGroup
 
-from oeps.clients.bigquery import BigQuery, get_client
-from oeps.clients.census import CensusClient
+from oeps.clients.bigquery import (
+    BigQuery,
+    LoadManifest,
+    QueryCache,
+    SOURCE_FORMATS,
+    get_client,
+    print_query_profile,
+)
+from oeps.clients.census import (
+    CensusClient,
+    process_geography,
+    GENERALIZATION_LEVELS,
+    TOPOJSON_QUANTIZATION,
+)
 from oeps.clients.explorer import Explorer
 from oeps.clients.frictionless import DataPackage
+from oeps.clients.local_engine import LocalEngine
 from oeps.clients.overture import get_filter_shape, get_data
 from oeps.clients.registry import Registry
 from oeps.config import (
@@ -22,6 +37,7 @@ from oeps.config import (
 from oeps.utils import (
     upload_to_s3,
     handle_overwrite,
+    DOWNLOAD_WORKERS,
 )
 
 # Make relative paths for directory configs so they can properly be used as default values for
@@ -111,8 +127,85 @@ def check_credentials():
     default=False,
     help="Mock operation and perform no create/delete actions.",
 )
-@add_common_opts(overwrite_opt, registry_opt)
-def load(name, table_only, dry_run, overwrite, registry_path):
+@click.option(
+    "--chunk-size",
+    type=int,
+    default=None,
+    help="Maximum number of rows per load job. Larger resources are split into several jobs that "
+    "append to the same table.",
+)
+@click.option(
+    "--source-format",
+    type=click.Choice(["parquet", "ndjson"]),
+    default="parquet",
+    help="Format used to upload rows to Big Query. `ndjson` (newline-delimited JSON) is slower and "
+    "larger, and is kept as a fallback.",
+)
+@click.option(
+    "--geometry-encoding",
+    type=click.Choice(["wkb", "wkt"]),
+    default="wkb",
+    help="Encoding for shapefile geometries in Parquet uploads. Ignored for `ndjson`, which always "
+    "uses GeoJSON.",
+)
+@click.option(
+    "--geometry-precision",
+    type=int,
+    default=None,
+    help="Number of decimal places to keep in shapefile geometry coordinates. By default, full "
+    "precision is kept.",
+)
+@click.option(
+    "--skip-geometry-repair",
+    is_flag=True,
+    default=False,
+    help="Don't repair invalid shapefile geometries before they are loaded.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="Number of resources to read and load concurrently. Each worker runs its own load jobs.",
+)
+@click.option(
+    "--retries",
+    type=int,
+    default=3,
+    help="Number of times a load job is retried after a transient error, with exponential backoff.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="Load resources even if their source files, schema, and load options are unchanged "
+    "since the last successful load, as recorded in the local manifest. Implied by --overwrite.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Only send rows that were inserted, changed, or deleted since the last load, and apply "
+    "them to the existing table with a MERGE. Falls back to a full reload if needed.",
+)
+@add_common_opts(overwrite_opt, registry_opt, verbose_opt)
+def load(
+    name,
+    table_only,
+    dry_run,
+    chunk_size,
+    source_format,
+    geometry_encoding,
+    geometry_precision,
+    skip_geometry_repair,
+    jobs,
+    retries,
+    force,
+    incremental,
+    overwrite,
+    registry_path,
+    verbose,
+):
     """Load a data resource to a big query table. The data resource schema should provide all field
     and table configuration information that is needed to create the table and load data into it."""
 
@@ -131,55 +224,185 @@ def load(name, table_only, dry_run, overwrite, registry_path):
     else:
         to_load = data_resources
 
-    for resource in to_load:
-        if name and resource["name"] != name:
-            continue
-
-        if table_only:
-            table = bq.create_table(resource, overwrite=overwrite)
-            print(table)
-            exit()
+    if table_only:
+        table = bq.create_table(to_load[0], overwrite=overwrite)
+        print(table)
+        exit()
 
-        else:
-            start = datetime.now()
-            print(f"\nVALIDATE INPUT SOURCE: {resource['path']}")
-            rows, errors = bq.load_rows_from_resource(resource)
-            messages += errors
-            print(f"WARNINGS ENCOUNTERED: {len(errors)}")
-            for e in errors:
-                print("  " + e)
-
-            if not dry_run:
-                print(f"\nBEGIN LOAD: {resource['name']}")
-                table = bq.create_table(resource, overwrite=overwrite)
-                print(f"TABLE CREATED: {table}")
-                load_job = bq.load_table(
-                    rows, resource["bq_dataset_name"], resource["bq_table_name"]
+    def print_resource_summary(summary):
+        if summary["skipped"]:
+            print("SKIPPED: source and schema unchanged since last load")
+            return
+        print(f"WARNINGS ENCOUNTERED: {len(summary['warnings'])}")
+        for e in summary["warnings"]:
+            print("  " + e)
+        report = summary["coercion_report"]
+        coerced = sum([i["coerced"] for i in report.values()])
+        nulled = sum([i["nulled"] for i in report.values()])
+        print(f"VALUES COERCED: {coerced}, NULLED: {nulled}")
+        if verbose:
+            for col, counts in report.items():
+                print(
+                    f"  {col} ({counts['type']}): {counts['coerced']} coerced, "
+                    f"{counts['nulled']} nulled"
                 )
-                print(f"JOB COMPLETE: {load_job}")
-                print(f"TIME ELAPSED: {datetime.now()-start}")
-
+        if summary["changes"] is not None:
+            changes = summary["changes"]
+            print(
+                f"ROWS INSERTED: {len(changes['inserted'])}, "
+                f"CHANGED: {len(changes['changed'])}, "
+                f"DELETED: {len(changes['deleted'])}"
+            )
+        if dry_run:
+            print(f"BYTES SERIALIZED ({source_format}): {summary['bytes']}")
+        else:
+            print(f"JOBS COMPLETE: {summary['jobs']}, OUTPUT ROWS: {summary['rows']}")
+        print(f"TIME ELAPSED: {summary['elapsed']}")
+
+    load_kwargs = {
+        "overwrite": overwrite,
+        "dry_run": dry_run,
+        "chunk_size": chunk_size,
+        "source_format": SOURCE_FORMATS[source_format],
+        "geometry_encoding": geometry_encoding,
+        "geometry_precision": geometry_precision,
+        "repair_geometry": not skip_geometry_repair,
+        "retries": retries,
+        "manifest": LoadManifest(),
+        "force": force,
+        "incremental": incremental,
+    }
+
+    start = datetime.now()
+    summaries, failures = [], {}
+    if jobs > 1:
+        # resources are read and serialized in a pool of threads, so several load
+        # jobs are in flight at once. output is printed as each resource finishes.
+        print(f"\nLOADING {len(to_load)} RESOURCES WITH {jobs} WORKERS")
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(bq.load_resource, resource, **load_kwargs): resource
+                for resource in to_load
+            }
+            for future in as_completed(futures):
+                resource = futures[future]
+                print(f"\nFINISHED: {resource['name']}")
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    print(f"FAILED: {e}")
+                    failures[resource["name"]] = e
+                    continue
+                print_resource_summary(summary)
+                summaries.append(summary)
+    else:
+        for resource in to_load:
+            print(f"\nVALIDATE AND LOAD INPUT SOURCE: {resource['path']}")
+            try:
+                summary = bq.load_resource(resource, **load_kwargs)
+            except Exception as e:
+                print(f"FAILED: {e}")
+                failures[resource["name"]] = e
+                continue
+            print_resource_summary(summary)
+            summaries.append(summary)
+
+    print("\nSUMMARY")
+    for summary in sorted(summaries, key=lambda i: i["name"]):
+        messages += summary["warnings"]
+        if summary["skipped"]:
+            print(f"  {summary['name']} -> {summary['table']}: skipped (unchanged)")
+            continue
+        print(
+            f"  {summary['name']} -> {summary['table']}: {summary['rows']} rows, "
+            f"{summary['jobs']} jobs, {len(summary['warnings'])} warnings, "
+            f"{summary['elapsed']}"
+        )
+    for name, e in failures.items():
+        print(f"  {name}: FAILED ({e})")
+    skipped = len([i for i in summaries if i["skipped"]])
+    print(
+        f"RESOURCES LOADED: {len(summaries) - skipped}, SKIPPED: {skipped}, "
+        f"FAILED: {len(failures)}"
+    )
+    print(f"TOTAL TIME ELAPSED: {datetime.now() - start}")
     print(f"ERRORS/WARNINGS ENCOUNTERED: {len(messages)}")
 
+    if failures:
+        exit(1)
+
 
 @bigquery_grp.command()
 @click.option(
     "--output",
     "-o",
-    help="Output file for export. Must end with .csv for CSV or .shp for ESRI Shapefile.",
+    help="Output file for export. Must end with .csv for CSV, .parquet for GeoParquet, .fgb for "
+    "FlatGeobuf, or .shp for ESRI Shapefile.",
 )
 @click.option("--sql-file", help="Path to file with SQL SELECT statement to run.")
-def export(output, sql_file):
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    default=False,
+    help="Always run the query in BigQuery, instead of using locally cached results from an "
+    "earlier run. Results are only reused while none of the queried tables have changed.",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="Estimate the bytes the query will scan, then run it and print the job statistics and "
+    "query plan stages. Full table scans of the spatial dataset are flagged.",
+)
+@click.option(
+    "--profile-format",
+    type=click.Choice(["table", "json"]),
+    default="table",
+    help="Format of the --profile output.",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["bigquery", "local"]),
+    default="bigquery",
+    help="Where to run the query. `local` runs it in an embedded DuckDB database, into which "
+    "registry resources are loaded (from their source files) the first time a query uses them.",
+)
+@add_common_opts(overwrite_opt, registry_opt)
+def export(
+    output,
+    sql_file,
+    no_cache,
+    profile,
+    profile_format,
+    engine,
+    overwrite,
+    registry_path,
+):
     """Runs a SQL statement, which must be provided in a .sql file, and the results are printed to the console
-    or saved to a CSV or SHP output file, based on the destination argument."""
+    or saved to a CSV, GeoParquet, FlatGeobuf, or SHP output file, based on the destination argument.
 
-    client = BigQuery()
+    With `--engine local`, use --overwrite to reload the tables referenced by the query."""
+
+    if engine == "local":
+        registry = Registry(registry_path)
+        client = LocalEngine(resources=registry.get_all_sources())
+    else:
+        client = BigQuery()
 
-    if sql_file:
-        client.run_query_from_file(sql_file)
+    if sql_file and engine == "local":
+        client.run_query_from_file(sql_file, overwrite=overwrite)
+    elif sql_file:
+        client.run_query_from_file(
+            sql_file, cache=None if no_cache else QueryCache(), profile=profile
+        )
+        if client.query_profile:
+            print_query_profile(client.query_profile, format=profile_format)
 
     if output:
-        client.export_results(output)
+        try:
+            client.export_results(output)
+        except ValueError as e:
+            raise click.ClickException(str(e))
 
     else:
         client.print_results()
@@ -208,11 +431,16 @@ census_grp = AppGroup(
 @click.option(
     "--format",
     "-f",
-    type=click.Choice(["shp", "geojson", "pmtiles"]),
+    type=click.Choice(
+        ["shp", "geojson", "geojsonseq", "topojson", "geoparquet", "fgb", "pmtiles"]
+    ),
     default=["shp", "geojson", "pmtiles"],
     multiple=True,
     help="Choose what output formats will be created. Options are `shp` (shapefile), `geojson` "
-    "(GeoJSON), and/or `pmtiles` (PMTiles).",
+    "(GeoJSON), `geojsonseq` (newline-delimited GeoJSON), `topojson` (quantized TopoJSON, "
+    "with only HEROP_ID, LABEL, and BBOX), "
+    "`geoparquet` (GeoParquet), `fgb` (FlatGeobuf, with a spatial index), and/or `pmtiles` "
+    "(PMTiles).",
 )
 @click.option(
     "--geography",
@@ -244,7 +472,52 @@ census_grp = AppGroup(
     "--no-cache",
     is_flag=True,
     default=False,
-    help="Force re-retrieval of files from FTP.",
+    help="Revalidate cached files with the FTP server, and re-download any that have changed.",
+)
+@click.option(
+    "--download-workers",
+    type=int,
+    default=DOWNLOAD_WORKERS,
+    help="Number of files to download at the same time, for geographies that are split into "
+    "many files.",
+)
+@click.option(
+    "--read-workers",
+    type=int,
+    default=None,
+    help="Number of processes used to read the downloaded files. Defaults to the number of CPUs.",
+)
+@click.option(
+    "--generalize",
+    "-l",
+    type=click.Choice(list(GENERALIZATION_LEVELS.keys())),
+    default=[],
+    multiple=True,
+    help="Also export generalized (simplified) versions of each geography, at one or more "
+    "levels: `5m` (1:5,000,000), `20m` (1:20,000,000), and/or `screen` (national view). "
+    "Shared boundaries are simplified together, so neighbors have no gaps or overlaps.",
+)
+@click.option(
+    "--quantization",
+    type=int,
+    default=TOPOJSON_QUANTIZATION,
+    help="Number of distinct coordinate positions along each axis in TopoJSON output. Lower "
+    "values give smaller files with less precise coordinates.",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="Read, transform, and export one source file at a time, so memory use is bounded by "
+    "the largest state instead of the whole country. Not available with topojson output or "
+    "--generalize.",
+)
+@click.option(
+    "--rebuild",
+    is_flag=True,
+    default=False,
+    help="Ignore the cached output of each stage (merged dataframes and exports), and run "
+    "every stage again. Downloaded files are still reused, see --no-cache.",
 )
 @click.option(
     "--upload", is_flag=True, default=False, help="Upload the processed files to S3."
@@ -263,6 +536,13 @@ census_grp = AppGroup(
     default="oeps",
     help="If output is uploaded to S3, use this prefix for the objects.",
 )
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="Number of geographies to process at the same time, each in its own process.",
+)
 @add_common_opts(verbose_opt)
 def get_geodata(
     format,
@@ -273,86 +553,190 @@ def get_geodata(
     tippecanoe_path,
     upload,
     no_cache,
+    download_workers,
+    read_workers,
+    generalize,
+    quantization,
+    stream,
+    rebuild,
     prefix,
+    jobs,
     verbose,
 ):
     """This command retrieves geodata from the US Census Bureau's FTP server, merges the files into single,
     nation-wide coverages, and then exports the merged files into various formats. Optionally upload these
     files directly to S3."""
 
-    client = CensusClient(verbose=verbose)
-
     print("year:", year)
     print("format(s):", format)
     print("geography(s):", geography)
     print("scale:", scale)
+    print("generalization level(s):", generalize)
 
     if "pmtiles" in format and not tippecanoe_path:
         print("pmtiles output must be accompanied by --tippecanoe-path")
         exit()
 
-    for geog in geography:
-        to_upload = []
-        print(f"\nPROCESSING: {geog}, {scale}, {year}")
-
-        client.year = year
-        client.geography = geog
-        client.scale = scale
-
-        # skip if there isn't a config entry for this geography/year combo
-        if (
-            year not in client.lookups["census-sources"]
-            or geog not in client.lookups["census-sources"][year][scale]
-        ):
-            print("no source configuration for this combo, skipping")
-            continue
-
-        print("downloading files...")
-        paths = client.download_all_files(no_cache=no_cache)
-
-        print("unzipping files...")
-        unzipped = client.unzip_files(paths)
-
-        print("creating dataframe...")
-        df = client.create_dataframe_from_files(unzipped)
-
-        print("add HEROP_ID...")
-        df = client.add_herop_id_to_dataframe(df)
-
-        print("add BBOX...")
-        df = client.add_bbox_to_dataframe(df)
+    if stream and ("topojson" in format or generalize):
+        print("--stream can't be used with topojson output or --generalize")
+        exit()
 
-        print("add LABEL...")
-        df = client.add_label_to_dataframe(df)
+    # when geographies run in parallel, each one reads its files in a single process
+    if jobs > 1 and read_workers is None:
+        read_workers = 1
+
+    process_kwargs = {
+        "year": year,
+        "scale": scale,
+        "formats": format,
+        "destination": destination,
+        "tippecanoe_path": tippecanoe_path,
+        "no_cache": no_cache,
+        "download_workers": download_workers,
+        "read_workers": read_workers,
+        "levels": generalize,
+        "quantization": quantization,
+        "stream": stream,
+        "rebuild": rebuild,
+        "verbose": verbose,
+    }
+
+    def upload_outputs(outputs):
+        start = time.perf_counter()
+        upload_to_s3(outputs, prefix=prefix, progress_bar=verbose)
+        return time.perf_counter() - start
+
+    start = datetime.now()
+    results, uploads, failures = [], {}, {}
+
+    # uploads run in a background thread, overlapping with the next geography
+    with ThreadPoolExecutor(max_workers=1) as upload_executor:
+
+        def handle_result(result):
+            results.append(result)
+            if upload and result["outputs"]:
+                print(
+                    f"{result['geography']}: uploading {len(result['outputs'])} files to S3..."
+                )
+                uploads[result["geography"]] = upload_executor.submit(
+                    upload_outputs, result["outputs"]
+                )
 
-        if "shp" in format:
-            print("generating shapefile...")
-            shp_output = client.export_to_shapefile(df, destination)
-            to_upload.append(shp_output["zipped"])
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {
+                    executor.submit(process_geography, geog, **process_kwargs): geog
+                    for geog in geography
+                }
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"{futures[future]}: FAILED: {e}")
+                        failures[futures[future]] = e
+                        continue
+                    handle_result(result)
+        else:
+            for geog in geography:
+                print(f"\nPROCESSING: {geog}, {scale}, {year}")
+                try:
+                    result = process_geography(geog, **process_kwargs)
+                except Exception as e:
+                    print(f"FAILED: {e}")
+                    failures[geog] = e
+                    continue
+                handle_result(result)
+
+    results = {i["geography"]: i for i in results}
+    for geog, future in uploads.items():
+        try:
+            results[geog]["timings"]["upload"] = future.result()
+        except Exception as e:
+            failures[geog] = e
+
+    print("\nTIMING SUMMARY (seconds)")
+    for geog in geography:
+        if geog not in results:
+            continue
+        result = results[geog]
+        if result["skipped"]:
+            print(f"  {result['geography']}: skipped")
+            continue
+        timings = result["timings"]
+        stages = ", ".join([f"{k} {v:.1f}" for k, v in timings.items()])
+        print(f"  {result['geography']}: {stages}, total {sum(timings.values()):.1f}")
+    for geog, e in failures.items():
+        print(f"  {geog}: FAILED ({e})")
+    print(f"TOTAL TIME ELAPSED: {datetime.now() - start}")
 
-        geojson_path = None
-        if "geojson" in format:
-            print("generating geojson...")
-            geojson_path = client.export_to_geojson(df, destination, overwrite=True)
-            to_upload.append(geojson_path)
+    print("\ndone.")
 
-        if "pmtiles" in format:
-            print("generating pmtiles...")
+    if failures:
+        exit(1)
 
-            # need geojson for this, but use existing if it was created already
-            if not geojson_path:
-                geojson_path = client.export_to_geojson(df, destination, overwrite=True)
-            pmtiles_path = client.export_to_pmtiles(
-                geojson_path, tippecanoe_path, destination
-            )
 
-            to_upload.append(pmtiles_path)
+@census_grp.command()
+@click.option(
+    "--geography",
+    "-g",
+    type=click.Choice(["state", "county", "tract", "bg", "place", "zcta"]),
+    default=["tract", "bg"],
+    multiple=True,
+    help="Specify a geography to benchmark.",
+)
+@click.option(
+    "--year",
+    "-y",
+    type=click.Choice(["2018", "2010"]),
+    default="2018",
+    help="Specify a year.",
+)
+@click.option(
+    "--scale",
+    "-s",
+    type=click.Choice(["500k", "tiger"]),
+    default="500k",
+    help="Specify a scale of geographic boundary file.",
+)
+@click.option(
+    "--read-workers",
+    type=int,
+    default=None,
+    help="Number of processes used to read files in parallel. Defaults to the number of CPUs.",
+)
+@click.option(
+    "--repeat",
+    type=int,
+    default=1,
+    help="Number of times to run each method. The best time is reported.",
+)
+@add_common_opts(verbose_opt)
+def benchmark_read(geography, year, scale, read_workers, repeat, verbose):
+    """Compares the time it takes to read and merge the source files for a geography in
+    parallel, sequentially, and with the previous one-by-one read_file() approach. Files are
+    downloaded first if they are not in the cache."""
 
-        if upload:
-            print(f"uploading {len(to_upload)} files to S3...")
-            upload_to_s3(to_upload, prefix=prefix, progress_bar=verbose)
+    client = CensusClient(verbose=verbose)
+    client.year = year
+    client.scale = scale
 
-    print("\ndone.")
+    results = {}
+    for geog in geography:
+        client.geography = geog
+        if geog not in client.lookups["census-sources"].get(year, {}).get(scale, {}):
+            print(f"no source configuration for {geog}, {scale}, {year}, skipping")
+            continue
+        print(f"\nBENCHMARKING: {geog}, {scale}, {year}")
+        paths = client.download_all_files()
+        shp_paths = client.get_shapefile_paths(paths)
+        results[geog] = client.benchmark_read(shp_paths, read_workers, repeat)
+
+    print("\ngeography  files  rows  legacy (s)  sequential (s)  parallel (s)  speedup")
+    for geog, t in results.items():
+        print(
+            f"{geog}  {t['files']}  {t['rows']}  {t['legacy']:.2f}  {t['sequential']:.2f}  "
+            f"{t['parallel']:.2f}  {t['legacy'] / t['parallel']:.1f}x"
+        )
 
 
 ## ~~ Frictionless Data Commands ~~
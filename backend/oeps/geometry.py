@@ -0,0 +1,177 @@
+import numpy
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+# number of duplicate ids that are listed by format_geometry_report()
+MAX_LISTED_IDS = 10
+
+# shapely type ids of Polygon and MultiPolygon
+POLYGONAL_TYPE_IDS = [3, 6]
+
+
+def geometry_values(series: pd.Series) -> numpy.ndarray:
+    """Returns the values of a geometry column as a numpy array of shapely
+    geometries (None for missing), which all shapely 2 functions operate on."""
+
+    return numpy.asarray(gpd.GeoSeries(series).values, dtype=object)
+
+
+def clean_geometry(series: pd.Series, precision: int = None, repair: bool = True):
+    """Prepares a geometry column for loading, as whole-array shapely operations.
+
+    If precision is provided, coordinates are snapped to a grid of that many decimal
+    places, which makes the encoded geometries smaller. If repair is True, invalid
+    geometries (self-intersections, bad ring order, etc.) are fixed with make_valid,
+    so BigQuery doesn't reject them when the GEOGRAPHY values are parsed.
+
+    (Multi)polygons are repaired with the "structure" method, which keeps them
+    polygonal: spikes and collapsed parts are dropped rather than returned as lines
+    in a GeometryCollection, which polygon formats like shapefile can't store. A
+    polygon that collapses entirely becomes an empty polygon.
+
+    Returns a new GeoSeries, and the number of geometries that were repaired."""
+
+    values = geometry_values(series)
+
+    repaired = 0
+    if repair:
+        invalid = ~shapely.is_valid(values) & ~shapely.is_missing(values)
+        repaired = int(invalid.sum())
+        if repaired:
+            polygonal = numpy.isin(shapely.get_type_id(values), POLYGONAL_TYPE_IDS)
+            structure = invalid & polygonal
+            linework = invalid & ~polygonal
+            values[structure] = shapely.make_valid(
+                values[structure], method="structure", keep_collapsed=False
+            )
+            values[linework] = shapely.make_valid(values[linework])
+
+    # set_precision needs valid input, and keeps the output valid
+    if precision is not None:
+        values = shapely.set_precision(values, 10**-precision)
+
+    return gpd.GeoSeries(values, index=series.index, crs=series.crs), repaired
+
+
+def check_geometry(
+    series: pd.Series,
+    ids: pd.Series = None,
+    precision: int = None,
+    repair: bool = True,
+    orient: bool = True,
+):
+    """Checks and repairs a whole geometry column at once, before it is exported or
+    loaded. Finds invalid geometries (with the reason for each), repeated vertices,
+    and empty or missing geometries, and if ids are provided, duplicate ids.
+
+    If repair is True, repeated vertices are removed and invalid geometries are
+    fixed (see clean_geometry(), which also applies precision). If orient is True,
+    polygon exteriors are normalized to counter-clockwise and interiors to
+    clockwise, as GeoJSON (RFC 7946) expects.
+
+    Returns a new GeoSeries, and a report dict with the count of each problem."""
+
+    values = geometry_values(series)
+    missing = shapely.is_missing(values)
+    invalid = ~shapely.is_valid(values) & ~missing
+
+    # validity reasons include the location, e.g. "Self-intersection[0.5 0.5]"
+    reasons = pd.Series(shapely.is_valid_reason(values[invalid]), dtype=object)
+    reason_counts = reasons.str.split("[").str[0].value_counts().to_dict()
+
+    deduplicated = shapely.remove_repeated_points(values)
+    repeated = shapely.get_num_coordinates(deduplicated) < shapely.get_num_coordinates(
+        values
+    )
+    if repair:
+        values = deduplicated
+
+    cleaned, repaired = clean_geometry(
+        gpd.GeoSeries(values, index=series.index, crs=series.crs),
+        precision=precision,
+        repair=repair,
+    )
+
+    reoriented = 0
+    if orient:
+        values = geometry_values(cleaned)
+        oriented = shapely.orient_polygons(values)
+        reoriented = int((~shapely.equals_identical(values, oriented) & ~missing).sum())
+        cleaned = gpd.GeoSeries(oriented, index=series.index, crs=series.crs)
+
+    duplicate_ids = []
+    if ids is not None:
+        duplicate_ids = sorted(ids[ids.duplicated(keep=False)].dropna().unique())
+
+    report = {
+        "features": len(values),
+        "missing": int(missing.sum()),
+        "empty": int((shapely.is_empty(geometry_values(series)) & ~missing).sum()),
+        "invalid": int(invalid.sum()),
+        "invalid_reasons": reason_counts,
+        "repeated_vertices": int(repeated.sum()),
+        "repaired": repaired,
+        "reoriented": reoriented,
+        "duplicate_ids": duplicate_ids,
+    }
+
+    return cleaned, report
+
+
+def combine_geometry_reports(reports: list) -> dict:
+    """Adds up reports from check_geometry() that were run on parts of a dataset.
+    Ids that are duplicated across parts must be added to duplicate_ids separately."""
+
+    combined = {
+        "features": 0,
+        "missing": 0,
+        "empty": 0,
+        "invalid": 0,
+        "invalid_reasons": {},
+        "repeated_vertices": 0,
+        "repaired": 0,
+        "reoriented": 0,
+        "duplicate_ids": [],
+    }
+    for report in reports:
+        for key, value in report.items():
+            if key == "invalid_reasons":
+                for reason, count in value.items():
+                    combined[key][reason] = combined[key].get(reason, 0) + count
+            elif key == "duplicate_ids":
+                combined[key] = sorted(set(combined[key]) | set(value))
+            else:
+                combined[key] += value
+
+    return combined
+
+
+def format_geometry_report(report: dict) -> list:
+    """Returns a message for each problem in a check_geometry() report. Polygon
+    reorientation is a normalization rather than a problem, so it is not included."""
+
+    messages = []
+    if report["invalid"]:
+        reasons = ", ".join([f"{k}: {v}" for k, v in report["invalid_reasons"].items()])
+        if report["repaired"]:
+            messages.append(
+                f"{report['repaired']} invalid geometries repaired ({reasons})"
+            )
+        else:
+            messages.append(f"{report['invalid']} invalid geometries ({reasons})")
+    if report["repeated_vertices"]:
+        messages.append(
+            f"{report['repeated_vertices']} geometries with repeated vertices"
+        )
+    if report["empty"]:
+        messages.append(f"{report['empty']} empty geometries")
+    if report["missing"]:
+        messages.append(f"{report['missing']} missing geometries")
+    if report["duplicate_ids"]:
+        listed = ", ".join(map(str, report["duplicate_ids"][:MAX_LISTED_IDS]))
+        if len(report["duplicate_ids"]) > MAX_LISTED_IDS:
+            listed += ", ..."
+        messages.append(f"{len(report['duplicate_ids'])} duplicate ids: {listed}")
+
+    return messages
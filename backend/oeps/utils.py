@@ -1,11 +1,16 @@
 import os
 import sys
 import json
+import hashlib
 import click
 import shutil
 import threading
 import boto3
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import List
 from tqdm import tqdm
 from glob import glob
@@ -19,6 +24,15 @@ BQ_TYPE_LOOKUP = {
     "number": "NUMERIC",
 }
 
+# number of concurrent downloads in download_files(), also the connection pool size
+DOWNLOAD_WORKERS = 8
+
+# number of retries (with exponential backoff) for failed download requests
+DOWNLOAD_RETRIES = 5
+
+_session = None
+_session_lock = threading.Lock()
+
 
 def load_json(path) -> dict:
     with open(path, "r") as o:
@@ -72,34 +86,186 @@ def upload_to_s3(paths: List[Path], prefix: str = None, progress_bar: bool = Fal
             print(f"\n  https://{bucket}.s3.{region}.amazonaws.com/{key}")
 
 
-def download_file(url, filepath, desc=None, progress_bar=False, no_cache: bool = False):
-    if Path(filepath).is_file() and not no_cache:
-        if progress_bar:
-            print(f"{desc}: use cached file")
-        return filepath
+def get_session() -> requests.Session:
+    """Returns a requests Session that is shared by all downloads, so connections to
+    the same host are pooled and reused across files and threads. Connection errors
+    and 429/5xx responses are retried with exponential backoff."""
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=DOWNLOAD_RETRIES,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["HEAD", "GET"],
+            )
+            adapter = HTTPAdapter(
+                pool_connections=DOWNLOAD_WORKERS,
+                pool_maxsize=DOWNLOAD_WORKERS,
+                max_retries=retry,
+            )
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+    return _session
+
+
+def download_file(
+    url,
+    filepath,
+    desc=None,
+    progress_bar=False,
+    no_cache: bool = False,
+    progress: tqdm = None,
+):
+    """Downloads a url to the provided filepath. If progress (a shared tqdm bar) is
+    provided, it is updated instead of creating a progress bar for this file.
+
+    Content is written to a .part file that is renamed once complete, so an
+    interrupted download is never mistaken for a cached file. The next call resumes
+    the .part file with an HTTP Range request. The ETag and Last-Modified headers are
+    stored in a .meta.json sidecar file, and used to validate resumed downloads.
+
+    Existing files are used as-is, unless no_cache=True. In that case the file is
+    revalidated with the server, and only downloaded again if it has changed."""
+
+    filepath = Path(filepath)
+    part_path = Path(f"{filepath}.part")
+    meta_path = Path(f"{filepath}.meta.json")
+    meta = load_json(meta_path) if meta_path.is_file() else {}
+    if meta.get("url") != url:
+        meta = {}
+    validator = meta.get("etag") or meta.get("last_modified")
+
+    # byte offsets for resumed downloads must refer to the unencoded content
+    headers = {"Accept-Encoding": "identity"}
+    if filepath.is_file():
+        if not no_cache:
+            if progress_bar and progress is None:
+                print(f"{desc}: use cached file")
+            return filepath
+        # conditional request, the server responds with 304 if nothing changed
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    elif part_path.is_file() and validator:
+        # if the file changed since the .part was started, If-Range makes the
+        # server send the whole file instead of the rest of it
+        headers["Range"] = f"bytes={part_path.stat().st_size}-"
+        headers["If-Range"] = validator
 
     # Streaming, so we can iterate over the response.
-    r = requests.get(url, stream=True)
+    r = get_session().get(url, stream=True, timeout=60, headers=headers)
 
-    # Total size in bytes.
+    if r.status_code == 304:
+        r.close()
+        if progress_bar and progress is None:
+            print(f"{desc}: not modified")
+        return filepath
+
+    if r.status_code == 416:
+        # the .part file already holds all bytes, or it doesn't match the file anymore
+        r.close()
+        if part_path.stat().st_size == meta.get("content_length"):
+            os.replace(part_path, filepath)
+            return filepath
+        part_path.unlink()
+        return download_file(url, filepath, desc, progress_bar, no_cache, progress)
+
+    r.raise_for_status()
+
+    # Total size in bytes (of the remaining content, if resuming).
     total_size = int(r.headers.get("content-length", 0))
     block_size = 1024
 
-    if progress_bar:
+    if r.status_code == 206:
+        mode = "ab"
+    else:
+        mode = "wb"
+        meta = {
+            "url": url,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "content_length": total_size or None,
+        }
+        # stored before the download starts, so it can be resumed
+        write_json(meta, meta_path)
+
+    t = None
+    if progress is not None:
+        with progress.get_lock():
+            progress.total += total_size
+            progress.refresh()
+        t = progress
+    elif progress_bar:
         t = tqdm(total=total_size, unit="iB", unit_scale=True, desc=desc)
 
-    with open(filepath, "wb") as f:
+    with open(part_path, mode) as f:
         for data in r.iter_content(block_size):
-            if progress_bar:
+            if t is not None:
                 t.update(len(data))
             f.write(data)
 
-    if progress_bar:
+    if t is not None and progress is None:
         t.close()
 
+    os.replace(part_path, filepath)
+    meta["downloaded"] = datetime.now().isoformat()
+    write_json(meta, meta_path)
+
     return filepath
 
 
+def download_files(
+    downloads: list,
+    workers: int = DOWNLOAD_WORKERS,
+    desc=None,
+    progress_bar=False,
+    no_cache: bool = False,
+):
+    """Downloads a list of (url, filepath) tuples concurrently, with one progress
+    bar for all files. Returns the filepaths in the same order as the input."""
+
+    progress = None
+    if progress_bar:
+        progress = tqdm(total=0, unit="iB", unit_scale=True, desc=desc)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    download_file, url, path, no_cache=no_cache, progress=progress
+                )
+                for url, path in downloads
+            ]
+            out_paths = [i.result() for i in futures]
+    finally:
+        if progress is not None:
+            progress.close()
+
+    return out_paths
+
+
+def hash_file(path, block_size: int = 1024 * 1024) -> str:
+    """Returns the sha256 hex digest of a file's content, read in blocks."""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as o:
+        for block in iter(lambda: o.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_json(data) -> str:
+    """Returns the sha256 hex digest of a JSON-serializable object, with keys sorted
+    so that the same content always produces the same hash."""
+
+    content = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
 def get_path_or_paths(path_input, glob_pattern="*"):
     if os.path.isdir(path_input):
         paths = glob(os.path.join(path_input, glob_pattern))
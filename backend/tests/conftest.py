@@ -1,3 +1,8 @@
+import hashlib
+import io
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
 import pytest
@@ -31,3 +36,57 @@ def client(app):
 @pytest.fixture()
 def runner(app):
     return app.test_cli_runner()
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Adds ETag validation and single byte range requests to the standard file
+    handler, and records the headers of each request."""
+
+    requests = []
+
+    def send_head(self):
+        RangeRequestHandler.requests.append(dict(self.headers))
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            return super().send_head()
+        content = path.read_bytes()
+        etag = f'"{hashlib.md5(content).hexdigest()}"'
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return None
+
+        status, start = 200, 0
+        byte_range = self.headers.get("Range")
+        if byte_range and self.headers.get("If-Range", etag) == etag:
+            start = int(byte_range.split("=")[1].rstrip("-"))
+            if start >= len(content):
+                self.send_response(416)
+                self.end_headers()
+                return None
+            status = 206
+
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        return io.BytesIO(content[start:])
+
+
+@pytest.fixture()
+def file_server(tmp_path):
+    """Serves files from a temporary directory over HTTP."""
+
+    served = tmp_path / "served"
+    served.mkdir()
+    RangeRequestHandler.requests = []
+    handler = partial(RangeRequestHandler, directory=str(served))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield served, f"http://127.0.0.1:{server.server_address[1]}"
+
+    server.shutdown()
+    server.server_close()
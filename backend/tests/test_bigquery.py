@@ -0,0 +1,738 @@
+import decimal
+import io
+import json
+import os
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import geopandas as gpd
+import numpy
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import requests
+from google.api_core.exceptions import (
+    BadRequest,
+    Conflict,
+    InternalServerError,
+    NotFound,
+    ServiceUnavailable,
+)
+from google.cloud.bigquery import SchemaField
+from google.cloud.bigquery.job import QueryPlanEntry
+import shapely
+from shapely.geometry import Polygon, box
+
+from oeps.clients.bigquery import (
+    BigQuery,
+    ChunkedReader,
+    LoadManifest,
+    QueryCache,
+    coerce_dataframe,
+    diff_rows,
+    encode_geometry,
+    find_full_scans,
+    get_partitioning,
+    get_resource_fingerprint,
+    hash_rows,
+    iter_parquet,
+    iter_parts,
+    localize_resource,
+    normalize_sql,
+    read_resource,
+    write_batches,
+    write_snapshot,
+)
+from oeps.commands import bigquery_grp
+from oeps.geometry import clean_geometry
+
+from .conftest import RangeRequestHandler
+
+
+def test_coerce_dataframe():
+    """Test column-at-a-time coercion of source values to schema field types."""
+
+    df = pd.DataFrame(
+        {
+            "HEROP_ID": ["050US17031", "050US17043", "050US17089", "050US17097"],
+            "Count": ["12", "23493.3434", "NA", "abc"],
+            "Rate": ["0.5", "inf", numpy.nan, "-Infinity"],
+            "Flag": ["Yes", "0", "maybe", None],
+            "Date": ["1/5/2020", "12/31/1999", numpy.nan, "2020-01-01"],
+            "Total": ["123456789.12345679", "1e30", "-1e29", "3.14159265358979323"],
+            "Big": ["9007199254740993", "99999999999999999999", "-12.6", " 7 "],
+        },
+        dtype="object",
+    )
+    fields = [
+        {"name": "HEROP_ID", "type": "string"},
+        {"name": "Count", "type": "integer"},
+        {"name": "Rate", "type": "number"},
+        {"name": "Flag", "type": "boolean"},
+        {"name": "Date", "type": "date"},
+        {"name": "Total", "type": "number"},
+        {"name": "Big", "type": "integer"},
+    ]
+
+    df, report = coerce_dataframe(df, fields)
+
+    assert df["Count"].tolist() == [12, 23493, None, None]
+    assert df["Rate"].tolist() == [0.5, None, None, None]
+    assert df["Flag"].tolist() == [True, False, None, None]
+    assert df["Date"].tolist() == ["2020-01-05", "1999-12-31", None, None]
+
+    assert report["HEROP_ID"] == {
+        "type": "string",
+        "coerced": 4,
+        "nulled": 0,
+        "invalid": 0,
+    }
+    assert report["Count"]["nulled"] == 2
+    assert report["Count"]["invalid"] == 1
+    assert report["Flag"]["nulled"] == 2
+    assert report["Flag"]["invalid"] == 0
+    assert report["Date"]["invalid"] == 1
+    # values that don't fit in a BigQuery NUMERIC are reported, not loaded
+    assert df["Total"].tolist() == [123456789.12345679, None, None, 3.141592653589793]
+    assert report["Total"]["invalid"] == 2
+    # whole numbers are parsed exactly, and those that don't fit in an int64 are
+    # reported instead of being corrupted by a float conversion
+    assert df["Big"].tolist() == [9007199254740993, None, -13, 7]
+    assert report["Big"]["invalid"] == 1
+
+    # all values must be native types that can be serialized
+    for row in df.to_dict(orient="records"):
+        json.dumps(row)
+
+
+def test_streamed_parts():
+    """Test that rows are split into parts and streamed back through ChunkedReader."""
+
+    df = pd.DataFrame(
+        {"HEROP_ID": [f"040US{i:02}" for i in range(12)], "Ct": range(12)}
+    )
+    df["Ct"] = df["Ct"].astype(object)
+
+    parts = list(iter_parts(df, chunk_size=5))
+    assert len(parts) == 3
+
+    lines = []
+    for part in parts:
+        reader = ChunkedReader(part)
+        content = b""
+        while True:
+            piece = reader.read(7)
+            content += piece
+            if len(piece) < 7:
+                break
+        assert reader.tell() == len(content)
+        lines += content.decode("utf-8").splitlines()
+
+    assert [json.loads(i) for i in lines] == df.to_dict(orient="records")
+
+    # a resource with no rows has no parts, with or without a chunk size
+    assert list(iter_parts(df.iloc[:0])) == []
+    assert list(iter_parts(df.iloc[:0], chunk_size=5)) == []
+
+
+def test_parquet_part():
+    """Test that a streamed Parquet part is typed according to the registry schema."""
+
+    df = gpd.GeoDataFrame(
+        {
+            "HEROP_ID": ["040US17", "040US18"],
+            "Ct": [4, None],
+            "Rate": [0.25, 123456789.12345679],
+            "Date": ["2020-01-05", None],
+        },
+        geometry=[box(0, 0, 1, 1), None],
+    ).rename_geometry("geom")
+    fields = [
+        {"name": "HEROP_ID", "type": "string"},
+        {"name": "Ct", "type": "integer"},
+        {"name": "Rate", "type": "number"},
+        {"name": "Date", "type": "date"},
+    ]
+    df, report = coerce_dataframe(df, fields)
+
+    content = b"".join(iter_parquet(df, fields, batch_rows=1))
+    table = pq.read_table(io.BytesIO(content))
+
+    assert table.num_rows == 2
+    assert table.schema.field("Ct").type == pa.int64()
+    assert table.schema.field("Rate").type == pa.decimal128(38, 9)
+    assert table.schema.field("Date").type == pa.date32()
+    assert table.schema.field("geom").type == pa.binary()
+    assert table.column("Ct").to_pylist() == [4, None]
+    # decimals hold the value as written, without binary float artifacts
+    assert table.column("Rate").to_pylist() == [
+        decimal.Decimal("0.250000000"),
+        decimal.Decimal("123456789.123456790"),
+    ]
+    assert shapely.from_wkb(table.column("geom")[0].as_py()).equals(box(0, 0, 1, 1))
+
+
+def test_load_manifest(tmp_path):
+    """Test that resource fingerprints only match while source and schema are unchanged."""
+
+    source = tmp_path / "T_Test.csv"
+    source.write_text("HEROP_ID,Ct\n140US01,1\n")
+    resource = {
+        "name": "t-test",
+        "path": str(source),
+        "format": "csv",
+        "bq_dataset_name": "tabular",
+        "bq_table_name": "T_Test",
+        "schema": {"fields": [{"name": "HEROP_ID", "type": "string"}]},
+    }
+
+    local, source_hash = localize_resource(resource, tmp_path / "sources")
+    fingerprint = get_resource_fingerprint(local, source_hash)
+    assert local["path"] == str(tmp_path / "sources" / "T_Test.csv")
+
+    manifest = LoadManifest(tmp_path / "manifest.json")
+    assert not manifest.is_current("t-test", fingerprint)
+    manifest.record("t-test", fingerprint, {"table": "tabular.T_Test", "rows": 1})
+
+    manifest = LoadManifest(tmp_path / "manifest.json")
+    assert manifest.is_current("t-test", fingerprint)
+
+    resource["schema"]["fields"].append({"name": "Ct", "type": "integer"})
+    local, source_hash = localize_resource(resource, tmp_path / "sources")
+    assert not manifest.is_current(
+        "t-test", get_resource_fingerprint(local, source_hash)
+    )
+
+    resource["schema"]["fields"].pop()
+    source.write_text("HEROP_ID,Ct\n140US01,2\n")
+    local, source_hash = localize_resource(resource, tmp_path / "sources")
+    assert not manifest.is_current(
+        "t-test", get_resource_fingerprint(local, source_hash)
+    )
+
+
+def test_localize_remote_resource(tmp_path, file_server):
+    """Test that remote sources are revalidated rather than downloaded again, and
+    that HTTP errors are raised instead of reusing a stale copy."""
+
+    served, url = file_server
+    (served / "T_Test.csv").write_text("HEROP_ID,Ct\n140US01,1\n")
+    resource = {"name": "t-test", "path": f"{url}/T_Test.csv", "format": "csv"}
+
+    local, source_hash = localize_resource(resource, tmp_path / "sources")
+    out_path = tmp_path / "sources" / "T_Test.csv"
+    assert local["path"] == str(out_path)
+    assert out_path.read_text() == "HEROP_ID,Ct\n140US01,1\n"
+    assert not Path(f"{out_path}.part").exists()
+    mtime = out_path.stat().st_mtime_ns
+
+    local, cached_hash = localize_resource(resource, tmp_path / "sources")
+    assert "If-None-Match" in RangeRequestHandler.requests[-1]
+    assert out_path.stat().st_mtime_ns == mtime
+    assert cached_hash == source_hash
+
+    (served / "T_Test.csv").write_text("HEROP_ID,Ct\n140US01,2\n")
+    local, changed_hash = localize_resource(resource, tmp_path / "sources")
+    assert changed_hash != source_hash
+
+    resource["path"] = f"{url}/missing.csv"
+    with pytest.raises(requests.HTTPError):
+        localize_resource(resource, tmp_path / "sources")
+
+
+def test_diff_rows():
+    """Test that row hashes detect inserted, changed, and deleted rows by key."""
+
+    previous = pd.DataFrame(
+        {"HEROP_ID": ["140US01", "140US02", "140US03"], "Ct": [1, 2, 3]}
+    )
+    current = pd.DataFrame(
+        {"Ct": [1, 5, 4], "HEROP_ID": ["140US01", "140US02", "140US04"]}
+    )
+
+    # column order doesn't affect the hash
+    assert hash_rows(previous).equals(hash_rows(previous[["Ct", "HEROP_ID"]]))
+
+    changes = diff_rows(hash_rows(previous), hash_rows(current))
+    assert changes == {
+        "inserted": ["140US04"],
+        "changed": ["140US02"],
+        "deleted": ["140US03"],
+    }
+
+
+def test_clean_geometry():
+    """Test that geometries are snapped, repaired, and encoded as whole arrays."""
+
+    bowtie = Polygon([(0, 0), (1, 1), (1, 0), (0, 1), (0, 0)])
+    geoms = gpd.GeoSeries([box(0.123456, 0, 1, 1), bowtie, None])
+
+    cleaned, repaired = clean_geometry(geoms, precision=2)
+    assert repaired == 1
+    assert cleaned.is_valid[:2].all()
+    assert cleaned[0].bounds[0] == 0.12
+    assert cleaned[2] is None
+
+    geojson = encode_geometry(cleaned, "geojson")
+    assert json.loads(geojson[0])["type"] == "Polygon"
+    assert geojson[2] is None
+    assert shapely.from_wkb(encode_geometry(cleaned, "wkb")[0]).equals(cleaned[0])
+
+
+def test_get_partitioning():
+    """Test that partitioning config from the registry is validated against field types."""
+
+    resource = {
+        "bq_partitioning": {
+            "type": "range",
+            "field": "year",
+            "start": 1980,
+            "end": 2030,
+        }
+    }
+    range_partitioning, time_partitioning = get_partitioning(
+        resource, {"year": "INTEGER"}
+    )
+    assert range_partitioning.field == "year"
+    assert range_partitioning.range_.interval == 1
+    assert time_partitioning is None
+
+    with pytest.raises(ValueError):
+        get_partitioning(resource, {"year": "STRING"})
+
+    assert get_partitioning({}, {}) == (None, None)
+
+
+def test_query_cache(tmp_path):
+    """Test that query results are read back from the cache, and evicted by size."""
+
+    assert normalize_sql("SELECT *  -- all\nFROM\n  t;") == "SELECT * FROM t"
+
+    table = pa.table({"HEROP_ID": ["040US17", "040US18"], "Ct": [1, 2]})
+    cache = QueryCache(tmp_path)
+    assert cache.get("a") is None
+
+    path = cache.put("a", table.to_batches(max_chunksize=1))
+    assert cache.get("a") == path
+    assert pq.read_table(path).equals(table)
+    assert cache.put("empty", []) is None
+
+    # only the most recently used file is kept once the cache is full
+    cache.max_bytes = path.stat().st_size
+    os.utime(path, (0, 0))
+    cache.put("b", table.to_batches())
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+
+
+def test_write_batches(tmp_path):
+    """Test that query result batches are streamed to each export format."""
+
+    table = pa.table(
+        {
+            "HEROP_ID": ["040US17", "040US18", "040US19"],
+            "Ct": pa.array([1, None, 3], type=pa.decimal128(38, 9)),
+            "geom": [box(0, 0, 1, 1).wkt, box(1, 1, 2, 2).wkt, box(2, 2, 3, 3).wkt],
+        }
+    )
+    batches = table.to_batches(max_chunksize=1)
+
+    for ext in [".csv", ".parquet", ".fgb", ".shp"]:
+        path = tmp_path / f"out{ext}"
+        assert write_batches(batches, path, progress_bar=False) == 3
+        if ext == ".csv":
+            assert len(pd.read_csv(path)) == 3
+            lines = path.read_text().splitlines()
+            # only values that contain a delimiter are quoted
+            assert lines[:3] == [
+                "HEROP_ID,Ct,geom",
+                '040US17,1.000000000,"POLYGON ((1 0, 1 1, 0 1, 0 0, 1 0))"',
+                '040US18,,"POLYGON ((2 1, 2 2, 1 2, 1 1, 2 1))"',
+            ]
+            continue
+        df = gpd.read_parquet(path) if ext == ".parquet" else gpd.read_file(path)
+        # features in FlatGeobuf files are ordered by the spatial index
+        df = df.sort_values("HEROP_ID").reset_index(drop=True)
+        assert df["HEROP_ID"].tolist() == ["040US17", "040US18", "040US19"]
+        assert df.geometry[0].equals(box(0, 0, 1, 1))
+
+    assert write_batches([], tmp_path / "empty.csv") == 0
+
+    # results without a geometry column can't be written to OGR formats
+    attributes = table.drop_columns(["geom"]).to_batches()
+    with pytest.raises(ValueError, match="no geom column"):
+        write_batches(attributes, tmp_path / "attributes.fgb", progress_bar=False)
+    assert not (tmp_path / "attributes.fgb").exists()
+    assert write_batches(attributes, tmp_path / "attributes.parquet") == 3
+
+
+def test_find_full_scans():
+    """Test that unfiltered reads of spatial tables are flagged in a query plan."""
+
+    plan = [
+        QueryPlanEntry.from_api_repr(
+            {
+                "name": "S00: Input",
+                "steps": [
+                    {
+                        "kind": "READ",
+                        "substeps": [
+                            "$1:HEROP_ID, $2:geom",
+                            "FROM p.spatial.tracts2018",
+                        ],
+                    }
+                ],
+            }
+        ),
+        QueryPlanEntry.from_api_repr(
+            {
+                "name": "S01: Input",
+                "steps": [
+                    {
+                        "kind": "READ",
+                        "substeps": [
+                            "$3:HEROP_ID, $4:geom",
+                            "FROM p.spatial.counties2018",
+                            "WHERE starts_with($3, '050US17')",
+                        ],
+                    }
+                ],
+            }
+        ),
+        QueryPlanEntry.from_api_repr(
+            {
+                "name": "S02: Input",
+                "steps": [{"kind": "READ", "substeps": ["FROM p.tabular.T_Latest"]}],
+            }
+        ),
+    ]
+
+    assert find_full_scans(plan) == ["p.spatial.tracts2018"]
+
+
+class RecordingClient:
+    """Stands in for the BigQuery API client, and records every method call."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append(name)
+
+
+def test_load_resource_read_error(tmp_path):
+    """Test that an unreadable source raises before the table is created or sized."""
+
+    bq = BigQuery.__new__(BigQuery)
+    bq.project_id = "project"
+    bq.client = RecordingClient()
+    resource = {
+        "name": "missing",
+        "path": str(tmp_path / "missing.csv"),
+        "format": "csv",
+        "bq_dataset_name": "tabular",
+        "bq_table_name": "Missing",
+        "schema": {"fields": [{"name": "HEROP_ID", "type": "string"}]},
+    }
+
+    for kwargs in [{"overwrite": True}, {"incremental": True}, {"dry_run": True}]:
+        with pytest.raises(Exception, match="unable to read missing"):
+            bq.load_resource(resource, **kwargs)
+    assert bq.client.calls == []
+
+
+class FlakyJob:
+    """Stands in for a load job, whose result() raises the provided errors in turn.
+    If failed is True, the job itself failed, and reports an error_result."""
+
+    def __init__(self, job_id, errors=None, failed=False):
+        self.job_id = job_id
+        self.errors = None
+        self.error_result = None
+        self.output_rows = 1
+        self._errors = errors or []
+        self._failed = failed
+
+    def result(self):
+        if self._errors:
+            if self._failed:
+                self.error_result = {"reason": "backendError"}
+            raise self._errors.pop(0)
+
+
+class FlakyClient(RecordingClient):
+    """Stands in for the BigQuery API client, where each upload has an outcome as
+    listed in outcomes: an exception raised before the job is created, or the
+    arguments of a FlakyJob, where "lost" is an exception raised after the job is
+    created (as if the response was lost)."""
+
+    def __init__(self, outcomes):
+        super().__init__()
+        self.outcomes = outcomes
+        self.uploads = []
+        self.jobs = {}
+
+    def get_table(self, table_id):
+        return SimpleNamespace(location="US")
+
+    def get_job(self, job_id, location=None):
+        if job_id not in self.jobs:
+            raise NotFound(job_id)
+        return self.jobs[job_id]
+
+    def load_table_from_file(self, file_obj, destination, job_config, job_id):
+        self.uploads.append(file_obj.read())
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        if job_id in self.jobs:
+            raise Conflict(job_id)
+        lost = outcome.pop("lost", None)
+        self.jobs[job_id] = FlakyJob(job_id, **outcome)
+        if lost:
+            raise lost
+        return self.jobs[job_id]
+
+
+def test_load_table_retries(monkeypatch):
+    """Test that failed uploads and load jobs are retried with exponential backoff,
+    and that a part is only uploaded again if its job wasn't created or failed."""
+
+    waits = []
+    monkeypatch.setattr("oeps.clients.bigquery.time.sleep", waits.append)
+
+    bq = BigQuery.__new__(BigQuery)
+    bq.project_id = "project"
+    bq.client = FlakyClient(
+        [
+            requests.exceptions.ConnectionError("connection reset"),
+            {"lost": requests.exceptions.Timeout("timed out"), "errors": []},
+            {"errors": [InternalServerError("backend error")], "failed": True},
+            {},
+        ]
+    )
+    parts = [[b"a", b"b"], [b"c"]]
+
+    # the second job is only polled again after a status request fails
+    bq.client.outcomes[1]["errors"] = [ServiceUnavailable("unavailable")]
+    jobs = bq.load_table(parts, "tabular", "T_Test", retries=3, backoff=1.0)
+    assert waits == [1.0, 2.0, 4.0, 1.0]
+    # a created job is never uploaded again, so its rows aren't appended twice
+    assert bq.client.uploads == [b"ab", b"ab", b"c", b"c"]
+    assert jobs[0].job_id.endswith("_1") and jobs[1].job_id.endswith("_2_1")
+    assert len(bq.client.jobs) == 3
+
+    # an upload with the id of an existing job returns that job
+    job_id = jobs[0].job_id
+    bq.client.outcomes = [{}]
+    table = SimpleNamespace(location="US")
+    assert bq._submit_load_job([b"a"], table, None, job_id) is jobs[0]
+
+    # once the retries run out, the last error is raised
+    waits.clear()
+    bq.client = FlakyClient(
+        [
+            requests.exceptions.Timeout("timed out"),
+            {"errors": [ServiceUnavailable("down")]},
+        ]
+    )
+    with pytest.raises(ServiceUnavailable):
+        bq.load_table(parts, "tabular", "T_Test", retries=1, backoff=1.0)
+    assert waits == [1.0]
+
+    # errors that aren't transient are raised right away
+    bq.client = FlakyClient([{"errors": [BadRequest("bad rows")]}])
+    with pytest.raises(BadRequest):
+        bq.load_table(parts, "tabular", "T_Test", retries=3, backoff=1.0)
+    assert bq.client.uploads == [b"ab"]
+
+
+def test_chunked_reader_seek():
+    """Test that a resumable upload can seek back into the last read to send a
+    failed chunk again, but not to anything before it."""
+
+    reader = ChunkedReader([b"abc", b"def", b"ghi"])
+    assert reader.read(4) == b"abcd"
+    assert reader.read(4) == b"efgh"
+    assert reader.seek(5) == 5
+    assert reader.read(4) == b"fghi"
+    assert reader.seek(0, io.SEEK_CUR) == 9
+    with pytest.raises(io.UnsupportedOperation):
+        reader.seek(4)
+    assert reader.read(4) == b""
+
+
+def test_load_jobs(runner, monkeypatch):
+    """Test that the load command loads resources in a pool of worker threads, and
+    reports failed resources alongside the loaded ones with a non-zero exit."""
+
+    loaded = {}
+
+    class FakeBigQuery:
+        def load_resource(self, data_resource, **kwargs):
+            loaded[data_resource["name"]] = threading.get_ident()
+            if data_resource["name"] == "states":
+                raise Exception("upload failed")
+            return {
+                "name": data_resource["name"],
+                "table": "dataset.table",
+                "skipped": False,
+                "warnings": [],
+                "coercion_report": {},
+                "changes": None,
+                "jobs": 1,
+                "rows": 10,
+                "elapsed": "0:00:01",
+            }
+
+    monkeypatch.setattr("oeps.commands.BigQuery", FakeBigQuery)
+    result = runner.invoke(
+        bigquery_grp,
+        [
+            "load",
+            "--jobs",
+            "3",
+            "--registry-path",
+            runner.app.config["TEST_REGISTRY_DIR"],
+        ],
+    )
+
+    assert result.exit_code == 1
+    assert "WITH 3 WORKERS" in result.output
+    assert len(loaded) == 7
+    assert threading.get_ident() not in loaded.values()
+    assert "states: FAILED (upload failed)" in result.output
+    assert "RESOURCES LOADED: 6, SKIPPED: 0, FAILED: 1" in result.output
+
+
+class MergeClient(RecordingClient):
+    """Stands in for the BigQuery API client during an incremental load. Existing
+    tables have the provided schema, and staged rows and queries are recorded."""
+
+    def __init__(self, schema):
+        super().__init__()
+        self.schema = schema
+        self.staged = []
+        self.queries = []
+        self.deleted = []
+
+    def get_table(self, table_id):
+        return SimpleNamespace(schema=self.schema, location="US")
+
+    def load_table_from_file(self, file_obj, destination, job_config, job_id):
+        self.staged.append(pq.read_table(io.BytesIO(file_obj.read())))
+        return FlakyJob(job_id)
+
+    def query(self, sql):
+        self.queries.append(sql)
+        return FlakyJob("merge")
+
+    def delete_table(self, table_id, not_found_ok=False):
+        self.deleted.append(table_id)
+
+
+def test_merge_rows(tmp_path, monkeypatch):
+    """Test that an incremental load stages only the changed rows, merges them on
+    the primary key, and drops the staging table, and that a changed column type
+    replaces the full table instead."""
+
+    monkeypatch.setattr("oeps.clients.bigquery.BIGQUERY_CACHE_DIR", tmp_path)
+    source = tmp_path / "T_Test.csv"
+    source.write_text("HEROP_ID,Ct\n040US17,1\n040US18,2\n040US19,3\n")
+    resource = {
+        "name": "t-test",
+        "path": str(source),
+        "format": "csv",
+        "bq_dataset_name": "tabular",
+        "bq_table_name": "T_Test",
+        "schema": {
+            "primaryKey": "HEROP_ID",
+            "fields": [
+                {"name": "HEROP_ID", "type": "string"},
+                {"name": "Ct", "type": "integer"},
+            ],
+        },
+    }
+    # the snapshot of the last load, after which one row changed, one was added,
+    # and one was deleted
+    previous = read_resource(resource)[0]
+    write_snapshot("t-test", hash_rows(previous))
+    source.write_text("HEROP_ID,Ct\n040US17,1\n040US18,5\n040US20,4\n")
+
+    bq = BigQuery.__new__(BigQuery)
+    bq.project_id = "project"
+    bq.client = MergeClient(
+        [SchemaField("HEROP_ID", "STRING"), SchemaField("Ct", "INTEGER")]
+    )
+    summary = bq.load_resource(resource, incremental=True)
+    assert summary["changes"] == {
+        "inserted": ["040US20"],
+        "changed": ["040US18"],
+        "deleted": ["040US19"],
+    }
+
+    staged = bq.client.staged[0].to_pylist()
+    assert sorted(staged, key=lambda i: i["HEROP_ID"]) == [
+        {"HEROP_ID": "040US18", "Ct": 5, "_change_type": "upsert"},
+        {"HEROP_ID": "040US19", "Ct": None, "_change_type": "delete"},
+        {"HEROP_ID": "040US20", "Ct": 4, "_change_type": "upsert"},
+    ]
+
+    assert len(bq.client.queries) == 1
+    sql = bq.client.queries[0]
+    assert "MERGE `project.tabular.T_Test` T" in sql
+    assert "USING `project.tabular.T_Test__staging` S" in sql
+    assert "ON T.`HEROP_ID` = S.`HEROP_ID`" in sql
+    assert "WHEN MATCHED AND S._change_type = 'delete' THEN DELETE" in sql
+    assert "WHEN MATCHED THEN UPDATE SET `Ct` = S.`Ct`" in sql
+    assert "INSERT (`HEROP_ID`, `Ct`) VALUES (S.`HEROP_ID`, S.`Ct`)" in sql
+    assert bq.client.deleted[-1] == "project.tabular.T_Test__staging"
+
+    # the table's Ct column is FLOAT, so its type changed and it can't be merged
+    bq.client = MergeClient(
+        [SchemaField("HEROP_ID", "STRING"), SchemaField("Ct", "FLOAT")]
+    )
+    summary = bq.load_resource(resource, incremental=True)
+    assert summary["changes"] is None
+    assert "table schema changed, replacing the full table" in summary["warnings"]
+    assert bq.client.queries == []
+    assert bq.client.deleted == ["project.tabular.T_Test"]
+    assert len(bq.client.staged[0]) == 3
+
+
+def test_load_resource_manifest(tmp_path, monkeypatch):
+    """Test that unchanged resources are skipped, unless they are overwritten or
+    loaded with different options, and that dry runs don't use the manifest."""
+
+    monkeypatch.setattr("oeps.clients.bigquery.BIGQUERY_CACHE_DIR", tmp_path)
+    source = tmp_path / "T_Test.csv"
+    source.write_text("HEROP_ID,Ct\n040US17,1\n")
+    resource = {
+        "name": "t-test",
+        "path": str(source),
+        "format": "csv",
+        "bq_dataset_name": "tabular",
+        "bq_table_name": "T_Test",
+        "schema": {"fields": [{"name": "HEROP_ID", "type": "string"}]},
+    }
+    manifest = LoadManifest(tmp_path / "manifest.json")
+    bq = BigQuery.__new__(BigQuery)
+    bq.project_id = "project"
+    bq.client = MergeClient([SchemaField("HEROP_ID", "STRING")])
+
+    summary = bq.load_resource(resource, dry_run=True, manifest=manifest)
+    assert not summary["skipped"]
+    assert not (tmp_path / "manifest.json").exists()
+    assert not (tmp_path / "sources").exists()
+
+    def skipped(**kwargs):
+        return bq.load_resource(resource, manifest=manifest, **kwargs)["skipped"]
+
+    assert not skipped()
+    assert skipped()
+    assert not skipped(overwrite=True)
+    assert not skipped(geometry_precision=6)
+    assert skipped(geometry_precision=6)
+    assert len(bq.client.staged) == 3
@@ -0,0 +1,478 @@
+import json
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import numpy
+import pandas as pd
+import pyarrow as pa
+import pytest
+import shapely
+from shapely.geometry import Polygon, box
+
+from oeps.clients import census
+from oeps.clients.census import (
+    CensusClient,
+    iter_geojson_features,
+    process_geography,
+    to_topojson,
+)
+from oeps.commands import census_grp
+
+
+def make_tract_zip(directory, statefp, count, name=None, extra=None):
+    """Writes a small zipped tract shapefile, named like the census source files.
+    Extra columns can be provided as a dict of lists."""
+
+    name = name or f"cb_2018_{statefp}_tract_500k"
+    df = gpd.GeoDataFrame(
+        {
+            "STATEFP": [statefp] * count,
+            "GEOID": [f"{statefp}031{n:06}" for n in range(count)],
+            "NAME": [str(n) for n in range(count)],
+            "LSAD": ["CT"] * count,
+            **(extra or {}),
+        },
+        geometry=[box(n, int(statefp), n + 1, int(statefp) + 1) for n in range(count)],
+        crs="EPSG:4269",
+    )
+    shp_dir = directory / name
+    shp_dir.mkdir()
+    df.to_file(shp_dir / f"{name}.shp")
+    zip_path = shutil.make_archive(directory / name, "zip", shp_dir)
+    shutil.rmtree(shp_dir)
+    return Path(zip_path), df
+
+
+def test_create_dataframe_from_zips(tmp_path):
+    """Test that zipped shapefiles are read in place and merged."""
+
+    client = CensusClient()
+    zip_paths, sources = [], []
+    for statefp, count in [("17", 3), ("18", 2)]:
+        zip_path, df = make_tract_zip(tmp_path, statefp, count)
+        zip_paths.append(zip_path)
+        sources.append(df)
+
+    shp_paths = client.get_shapefile_paths(zip_paths)
+    assert shp_paths[0].startswith("/vsizip/")
+
+    df = client.create_dataframe_from_files(shp_paths, workers=2)
+    assert df.equals(client.create_dataframe_from_files(shp_paths, workers=1))
+    assert len(df) == 5
+    assert df.crs == sources[0].crs
+    assert (
+        df["GEOID"].tolist()
+        == sources[0]["GEOID"].tolist() + sources[1]["GEOID"].tolist()
+    )
+
+    # nothing was extracted next to the archives
+    assert sorted([i.suffix for i in tmp_path.iterdir()]) == [".zip", ".zip"]
+
+    with pytest.raises(ValueError, match="no files to read"):
+        client.create_dataframe_from_files([])
+
+
+def legacy_herop_id(row, lvl, suffixes):
+    return f"{lvl}US{''.join([row[i] for i in suffixes])}"
+
+
+def legacy_bbox(row):
+    minx = round(row["minx"], 3)
+    miny = round(row["miny"], 3)
+    maxx = round(row["maxx"], 3)
+    maxy = round(row["maxy"], 3)
+    return f"{minx},{miny},{maxx},{maxy}"
+
+
+def legacy_label(row, name_field, lsad_lookup):
+    lsad = row.get("LSAD")
+    name = row.get(name_field)
+    if lsad:
+        position = None
+        if lsad in lsad_lookup:
+            lsad_value = lsad_lookup[lsad]["value"]
+            position = lsad_lookup[lsad]["position"]
+        else:
+            for k, v in lsad_lookup.items():
+                if lsad == v["value"]:
+                    lsad_value = lsad
+                    position = v["position"]
+
+        if position:
+            if position == "prefix":
+                name = f"{lsad_value} {name}"
+            else:
+                name = f"{name} {lsad_value}"
+
+    return name
+
+
+def test_derived_columns(tmp_path):
+    """Test that HEROP_ID, BBOX, and LABEL are identical to the row-by-row output."""
+
+    # coordinates that are exactly (or nearly) halfway between rounded values, whole
+    # numbers, and values that round to zero
+    coords = [2.675, -87.5235, 30.9005, 41.0, -0.0004, 1e-9, -161.3185, 0.0005]
+    lsads = ["06", "County", "District", "28", "45", "Township", "00", "", None, "XX"]
+    n = len(lsads) * 3
+    df = gpd.GeoDataFrame(
+        {
+            "GEOID": [f"17{i:03}" for i in range(n)],
+            "NAME": [f"Name {i}" for i in range(n)],
+            "LSAD": [lsads[i % len(lsads)] for i in range(n)],
+        },
+        geometry=[
+            box(
+                coords[i % len(coords)],
+                coords[(i + 1) % len(coords)],
+                coords[i % len(coords)] + 1.0005 * i,
+                coords[(i + 1) % len(coords)] + 0.0015 * i,
+            )
+            for i in range(n)
+        ],
+        crs="EPSG:4269",
+    )
+    df.to_file(tmp_path / "sample.shp")
+    df = gpd.read_file(tmp_path / "sample.shp")
+
+    client = CensusClient()
+    client.year, client.scale, client.geography = "2018", "500k", "county"
+    lvl = client.lookups["census-summary-levels"]["county"]
+    lsad_lookup = client.lookups["census-lsad"]
+
+    expected = pd.concat([df, df.bounds], axis=1)
+    herop_ids = expected.apply(lambda r: legacy_herop_id(r, lvl, ["GEOID"]), axis=1)
+    bboxes = expected.apply(legacy_bbox, axis=1)
+    labels = expected.apply(lambda r: legacy_label(r, "NAME", lsad_lookup), axis=1)
+
+    df = client.add_herop_id_to_dataframe(df)
+    df = client.add_bbox_to_dataframe(df)
+    df = client.add_label_to_dataframe(df)
+
+    assert df["HEROP_ID"].tolist() == herop_ids.tolist()
+    assert df["BBOX"].tolist() == bboxes.tolist()
+    assert df["LABEL"].tolist() == labels.tolist()
+
+
+def test_export_geoparquet_fgb(tmp_path):
+    """Test that GeoParquet and FlatGeobuf outputs round trip with their CRS."""
+
+    zip_path, df = make_tract_zip(tmp_path, "17", 4)
+    client = CensusClient()
+    client.year, client.scale, client.geography = "2018", "500k", "tract"
+
+    parquet_path = client.export_to_geoparquet(df, tmp_path)
+    fgb_path = client.export_to_fgb(df, tmp_path)
+    assert parquet_path.name == "tract-2018-500k.parquet"
+
+    for out_df in [gpd.read_parquet(parquet_path), gpd.read_file(fgb_path)]:
+        out_df = out_df.sort_values("GEOID").reset_index(drop=True)
+        assert out_df.crs == df.crs
+        assert out_df["GEOID"].tolist() == df["GEOID"].tolist()
+        assert out_df.geometry.equals(df.geometry)
+
+    # the spatial index allows reading only the features in a bbox
+    assert len(gpd.read_file(fgb_path, bbox=(0.5, 17.5, 1.5, 18.5))) == 2
+
+
+def make_fake_tippecanoe(directory):
+    """Writes a script that stands in for tippecanoe, copying stdin to the -o path
+    along with its args."""
+
+    tippecanoe = directory / "tippecanoe"
+    tippecanoe.write_text(
+        f"#!{sys.executable}\n"
+        "import sys\n"
+        "out = sys.argv[sys.argv.index('-o') + 1]\n"
+        "open(out, 'w').write(' '.join(sys.argv[1:]) + '\\n' + sys.stdin.read())\n"
+    )
+    tippecanoe.chmod(0o755)
+    return tippecanoe
+
+
+def test_export_pmtiles_stream(tmp_path):
+    """Test that features are streamed to tippecanoe as newline-delimited GeoJSON."""
+
+    zip_path, df = make_tract_zip(tmp_path, "17", 5)
+    client = CensusClient()
+    client.year, client.scale, client.geography = "2018", "500k", "tract"
+    df["HEROP_ID"] = "140US" + df["GEOID"]
+
+    chunks = list(iter_geojson_features(df, batch_rows=2))
+    assert len(chunks) == 3
+    features = [json.loads(i) for i in b"".join(chunks).splitlines()]
+    assert [i["properties"]["HEROP_ID"] for i in features] == df["HEROP_ID"].tolist()
+    assert features[0]["geometry"]["type"] == "Polygon"
+
+    tippecanoe = make_fake_tippecanoe(tmp_path)
+
+    pmtiles_path = client.export_to_pmtiles(df, tippecanoe, tmp_path)
+    args, *lines = pmtiles_path.read_text().splitlines()
+    assert "-P" in args.split()
+    assert not list(tmp_path.glob("*.geojson"))
+    properties = [json.loads(i)["properties"] for i in lines]
+    assert [i["HEROP_ID"] for i in properties] == df["HEROP_ID"].tolist()
+    assert "GEOID" not in properties[0]
+
+
+def test_generalize_dataframe():
+    """Test that generalized features keep shared edges, without gaps or overlaps."""
+
+    # two rows of three cells, where the vertical edges between cells are detailed
+    # zigzags that are shared by both neighbors
+    def edge(x, y0, y1):
+        steps = 200
+        return [
+            (x + (0.001 if n % 2 else 0), y0 + (y1 - y0) * n / steps)
+            for n in range(steps + 1)
+        ]
+
+    cells, ids = [], []
+    for row in range(2):
+        for col in range(3):
+            left = edge(col, row, row + 1)
+            right = edge(col + 1, row, row + 1)
+            cells.append(Polygon(left + right[::-1]))
+            ids.append(f"{row}{col}")
+    df = gpd.GeoDataFrame({"HEROP_ID": ids}, geometry=cells, crs="EPSG:4269")
+
+    client = CensusClient()
+    client.year, client.scale, client.geography = "2018", "500k", "tract"
+    client.level = "5m"
+    assert client.name_string == "tract-2018-500k-5m"
+
+    generalized = client.generalize_dataframe(df, "5m")
+    assert generalized["HEROP_ID"].tolist() == ids
+    original_count = df.geometry.count_coordinates().sum()
+    assert original_count > 10 * generalized.geometry.count_coordinates().sum()
+
+    # no overlaps, no gaps, and neighbors still share the same simplified edge
+    union = shapely.union_all(generalized.geometry.values)
+    assert abs(union.area - shapely.area(generalized.geometry.values).sum()) < 1e-9
+    assert abs(union.area - shapely.area(df.geometry.values).sum()) < 1e-2
+    shared = generalized.geometry[0].intersection(generalized.geometry[1])
+    assert shared.geom_type in ("LineString", "MultiLineString")
+    assert shared.length >= 1
+
+
+def decode_topojson_ring(topology, arc_indices):
+    scale, translate = (
+        topology["transform"]["scale"],
+        topology["transform"]["translate"],
+    )
+    ring = []
+    for index in arc_indices:
+        arc = topology["arcs"][index if index >= 0 else ~index]
+        x = y = 0
+        points = []
+        for dx, dy in arc:
+            x, y = x + dx, y + dy
+            points.append((x * scale[0] + translate[0], y * scale[1] + translate[1]))
+        if index < 0:
+            points.reverse()
+        ring += points[1:] if ring else points
+    return ring
+
+
+def test_to_topojson():
+    """Test that shared edges are stored once, and that features decode to the input."""
+
+    hole = box(10.25, 0.25, 10.75, 0.75)
+    df = gpd.GeoDataFrame(
+        {
+            "HEROP_ID": ["a", "b", "c", "d"],
+            "LABEL": ["A", "B", "C", "D"],
+            "GEOID": ["1", "2", "3", "4"],
+        },
+        geometry=[
+            box(0, 0, 1, 1),
+            box(1, 0, 2, 1),
+            Polygon(box(10, 0, 11, 1).exterior, [hole.exterior]),
+            None,
+        ],
+        crs="EPSG:4326",
+    )
+
+    topology = to_topojson(df, "tract", quantization=10000)
+    geometries = topology["objects"]["tract"]["geometries"]
+
+    # the shared edge of a and b is one arc, referenced in opposite directions
+    assert len(topology["arcs"]) == 5
+    shared = set(geometries[0]["arcs"][0]) & {~i for i in geometries[1]["arcs"][0]}
+    assert len(shared) == 1
+
+    assert geometries[0]["properties"] == {"HEROP_ID": "a", "LABEL": "A"}
+    assert geometries[3]["type"] is None
+    for geometry, original in zip(geometries[:3], df.geometry):
+        exterior, *interiors = [
+            decode_topojson_ring(topology, i) for i in geometry["arcs"]
+        ]
+        polygon = Polygon(exterior, interiors)
+        assert shapely.hausdorff_distance(polygon, original) < 1e-3
+
+
+def test_stream_files_to_outputs(tmp_path):
+    """Test that streamed outputs match the outputs of the in-memory pipeline."""
+
+    zip_paths = [make_tract_zip(tmp_path, i, 3)[0] for i in ["17", "18"]]
+    client = CensusClient()
+    client.year, client.scale, client.geography = "2018", "500k", "tract"
+    shp_paths = client.get_shapefile_paths(zip_paths)
+
+    df = client.create_dataframe_from_files(shp_paths, workers=1)
+    df = client.add_herop_id_to_dataframe(df)
+    df = client.add_bbox_to_dataframe(df)
+    df = client.add_label_to_dataframe(df)
+    df = client.check_geometries(df)
+
+    formats = ["shp", "geoparquet", "fgb", "geojson", "geojsonseq", "pmtiles"]
+    outputs = client.stream_files_to_outputs(
+        shp_paths, formats, tmp_path / "out", make_fake_tippecanoe(tmp_path)
+    )
+    assert list(outputs.keys()) == formats
+
+    for out_df in [
+        gpd.read_file(f"/vsizip/{outputs['shp']}"),
+        gpd.read_parquet(outputs["geoparquet"]),
+        gpd.read_file(outputs["fgb"]),
+        gpd.read_file(outputs["geojsonseq"]),
+    ]:
+        out_df = out_df.sort_values("HEROP_ID").reset_index(drop=True)
+        assert out_df["HEROP_ID"].tolist() == df["HEROP_ID"].tolist()
+        assert out_df["BBOX"].tolist() == df["BBOX"].tolist()
+        # shapefiles store exterior rings clockwise, so compare normalized rings
+        geometry = out_df.geometry.to_crs(df.crs).normalize()
+        assert geometry.geom_equals_exact(df.geometry.normalize(), 1e-6).all()
+
+    geojson = json.loads(outputs["geojson"].read_text())
+    assert len(geojson["features"]) == 6
+    assert len(outputs["pmtiles"].read_text().splitlines()) == 7
+
+
+def test_stream_mismatched_schemas(tmp_path):
+    """Test that streamed files with different field types, and missing or extra
+    fields, are written with a schema unified from all of them."""
+
+    zip_paths = [
+        make_tract_zip(
+            tmp_path, "17", 2, extra={"ALAND": numpy.array([1, 2], dtype="int32")}
+        )[0],
+        make_tract_zip(
+            tmp_path,
+            "18",
+            2,
+            extra={"ALAND": [2**40, 2**41], "AWATER": [0.5, 1.5]},
+        )[0],
+    ]
+    client = CensusClient()
+    client.year, client.scale, client.geography = "2018", "500k", "tract"
+    shp_paths = client.get_shapefile_paths(zip_paths)
+    assert [census.read_arrow_schema(p).field("ALAND").type for p in shp_paths] == [
+        pa.int32(),
+        pa.int64(),
+    ]
+
+    outputs = client.stream_files_to_outputs(
+        shp_paths, ["geoparquet", "fgb"], tmp_path / "out"
+    )
+    for out_df in [
+        gpd.read_parquet(outputs["geoparquet"]),
+        gpd.read_file(outputs["fgb"]),
+    ]:
+        out_df = out_df.sort_values("HEROP_ID").reset_index(drop=True)
+        assert out_df["ALAND"].tolist() == [1, 2, 2**40, 2**41]
+        assert out_df["AWATER"].isna().tolist() == [True, True, False, False]
+
+
+def test_process_geography_stage_cache(tmp_path, monkeypatch):
+    """Test that reruns skip cached stages, and restart from the first changed one."""
+
+    monkeypatch.setattr(census, "GEODATA_CACHE_DIR", tmp_path / "geodata")
+    raw_dir = tmp_path / "geodata" / "county" / "raw" / "2018" / "500k"
+    raw_dir.mkdir(parents=True)
+    make_tract_zip(raw_dir, "17", 3, name="cb_2018_us_county_500k")
+    kwargs = {"year": "2018", "scale": "500k", "destination": tmp_path / "out"}
+
+    result = process_geography("county", formats=["geoparquet"], **kwargs)
+    assert list(result["timings"]) == [
+        "download",
+        "read",
+        "transform",
+        "check",
+        "geoparquet",
+    ]
+    outputs = result["outputs"]
+
+    # nothing changed, so nothing is read or written
+    result = process_geography("county", formats=["geoparquet"], **kwargs)
+    assert list(result["timings"]) == ["download"]
+    assert result["outputs"] == outputs
+
+    # a new format starts from the cached transform
+    result = process_geography("county", formats=["geoparquet", "fgb"], **kwargs)
+    assert list(result["timings"]) == ["download", "transform-cached", "fgb"]
+
+    # a changed source file invalidates every stage
+    make_tract_zip(raw_dir, "17", 4, name="cb_2018_us_county_500k")
+    result = process_geography("county", formats=["geoparquet"], **kwargs)
+    assert list(result["timings"]) == [
+        "download",
+        "read",
+        "transform",
+        "check",
+        "geoparquet",
+    ]
+    assert len(gpd.read_parquet(result["outputs"][0])) == 4
+
+
+def test_get_geodata_jobs(runner, monkeypatch):
+    """Test that get-geodata runs every geography, uploads the outputs of those that
+    succeed, and exits non-zero if any geography fails."""
+
+    processed, uploaded = [], []
+    lock = threading.Lock()
+
+    def fake_process_geography(geography, **kwargs):
+        with lock:
+            processed.append(geography)
+        if geography == "place":
+            raise Exception("download failed")
+        return {
+            "geography": geography,
+            "outputs": [Path(f"{geography}.zip")],
+            "timings": {"download": 1.0},
+            "geometry_report": {},
+            "skipped": False,
+        }
+
+    def fake_upload_to_s3(paths, prefix, progress_bar):
+        uploaded.extend(paths)
+
+    # the pool runs in threads, so the patched functions are used by every job
+    monkeypatch.setattr("oeps.commands.ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr("oeps.commands.process_geography", fake_process_geography)
+    monkeypatch.setattr("oeps.commands.upload_to_s3", fake_upload_to_s3)
+
+    args = ["get-geodata", "-f", "shp", "-y", "2018", "--upload", "--jobs", "3"]
+    args += ["-g", "state", "-g", "county", "-g", "tract"]
+    result = runner.invoke(census_grp, args)
+    assert result.exit_code == 0, result.output
+    assert sorted(processed) == ["county", "state", "tract"]
+    assert sorted(uploaded) == [
+        Path("county.zip"),
+        Path("state.zip"),
+        Path("tract.zip"),
+    ]
+    assert "tract: download 1.0, upload" in result.output
+
+    processed.clear()
+    uploaded.clear()
+    result = runner.invoke(census_grp, args + ["-g", "place"])
+    assert result.exit_code == 1
+    assert sorted(processed) == ["county", "place", "state", "tract"]
+    assert len(uploaded) == 3
+    assert "place: FAILED (download failed)" in result.output
@@ -0,0 +1,78 @@
+import geopandas as gpd
+import pandas as pd
+import shapely
+from shapely.geometry import Polygon, box
+
+from oeps.clients.census import CensusClient
+from oeps.geometry import (
+    check_geometry,
+    combine_geometry_reports,
+    format_geometry_report,
+)
+
+
+def test_check_geometry():
+    """Test that geometry problems are counted, repaired, and normalized as whole arrays."""
+
+    bowtie = Polygon([(0, 0), (1, 1), (1, 0), (0, 1), (0, 0)])
+    repeated = Polygon([(0, 0), (1, 0), (1, 0), (1, 1), (0, 1), (0, 0)])
+    clockwise = box(0, 0, 1, 1, ccw=False)
+    geoms = gpd.GeoSeries([bowtie, repeated, clockwise, None, Polygon()])
+    ids = pd.Series(["a", "b", "c", "b", None])
+
+    checked, report = check_geometry(geoms, ids=ids)
+    assert report["features"] == 5
+    assert report["invalid"] == report["repaired"] == 1
+    assert report["invalid_reasons"] == {"Self-intersection": 1}
+    assert report["repeated_vertices"] == 1
+    assert report["missing"] == 1
+    assert report["empty"] == 1
+    assert report["duplicate_ids"] == ["b"]
+
+    assert checked[:3].is_valid.all()
+    assert shapely.get_num_coordinates(checked[1]) == 5
+    assert shapely.is_ccw(checked[2].exterior)
+    assert checked[3] is None
+
+    # repair can be turned off, in which case problems are only reported
+    unrepaired, unrepaired_report = check_geometry(geoms, repair=False, orient=False)
+    assert unrepaired_report["repaired"] == 0
+    assert not unrepaired[0].is_valid
+    assert unrepaired[2].equals_exact(clockwise, 0)
+
+    combined = combine_geometry_reports([report, unrepaired_report])
+    assert combined["features"] == 10
+    assert combined["invalid_reasons"] == {"Self-intersection": 2}
+    assert format_geometry_report(report) == [
+        "1 invalid geometries repaired (Self-intersection: 1)",
+        "1 geometries with repeated vertices",
+        "1 empty geometries",
+        "1 missing geometries",
+        "1 duplicate ids: b",
+    ]
+
+
+def test_check_geometry_keeps_polygons(tmp_path):
+    """Test that repaired spikes and collapsed polygons stay polygonal, so they can be
+    written to a polygon shapefile."""
+
+    spike = Polygon([(0, 0), (1, 0), (1, 1), (1, 2), (1, 1), (0, 1), (0, 0)])
+    collapsed = Polygon([(2, 0), (3, 0), (4, 0), (2, 0)])
+    df = gpd.GeoDataFrame(
+        {"HEROP_ID": ["a", "b", "c"]},
+        geometry=[spike, collapsed, box(5, 0, 6, 1)],
+        crs="EPSG:4269",
+    )
+
+    df.geometry, report = check_geometry(df.geometry, ids=df["HEROP_ID"])
+    assert report["repaired"] == 2
+    assert df.geom_type.tolist() == ["Polygon", "Polygon", "Polygon"]
+    assert df.geometry[0].equals(box(0, 0, 1, 1))
+    assert df.geometry[1].is_empty
+
+    client = CensusClient()
+    client.year, client.scale, client.geography = "2018", "500k", "tract"
+    shp_output = client.export_to_shapefile(df, tmp_path)
+    out_df = gpd.read_file(f"/vsizip/{shp_output['zipped']}")
+    assert out_df["HEROP_ID"].tolist() == ["a", "b", "c"]
+    assert out_df.geometry[0].equals(box(0, 0, 1, 1))
@@ -0,0 +1,48 @@
+import pandas as pd
+
+from oeps.clients.local_engine import LocalEngine
+
+
+def test_local_query(tmp_path):
+    """Test that templated SQL runs against resources loaded into the local database."""
+
+    resources = []
+    for table_name, rows in [
+        ("S_1980", "HEROP_ID,TotPop\n040US17,100\n040US18,NA\n"),
+        ("S_2010", "HEROP_ID,TotPop\n040US17,250\n040US19,300\n"),
+    ]:
+        source = tmp_path / f"{table_name}.csv"
+        source.write_text(rows)
+        resources.append(
+            {
+                "name": table_name.lower(),
+                "path": str(source),
+                "format": "csv",
+                "bq_dataset_name": "tabular",
+                "bq_table_name": table_name,
+                "schema": {
+                    "fields": [
+                        {"name": "HEROP_ID", "type": "string"},
+                        {"name": "TotPop", "type": "integer"},
+                    ]
+                },
+            }
+        )
+
+    sql_file = tmp_path / "query.sql"
+    sql_file.write_text(
+        "SELECT a.HEROP_ID, a.TotPop AS Pop1980, b.TotPop AS Pop2010\n"
+        "FROM PROJECT_ID.tabular.S_1980 a INNER JOIN PROJECT_ID.tabular.S_2010 b\n"
+        "ON a.HEROP_ID = b.HEROP_ID"
+    )
+
+    engine = LocalEngine(resources=resources, database=tmp_path / "oeps.duckdb")
+    engine.run_query_from_file(sql_file)
+    assert engine.table_exists("tabular", "S_1980")
+
+    output = tmp_path / "out.csv"
+    engine.export_results(str(output), progress_bar=False)
+    df = pd.read_csv(output)
+    assert df.to_dict(orient="records") == [
+        {"HEROP_ID": "040US17", "Pop1980": 100, "Pop2010": 250}
+    ]
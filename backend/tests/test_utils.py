@@ -0,0 +1,53 @@
+from oeps.utils import download_file, download_files
+
+from .conftest import RangeRequestHandler
+
+
+def test_download_files(tmp_path, file_server):
+    """Test that files are downloaded concurrently and returned in input order."""
+
+    served, url = file_server
+    downloads = []
+    for n in range(5):
+        source = served / f"tl_2018_{n:02}_tract.zip"
+        source.write_bytes(bytes([n]) * (n + 1) * 1000)
+        downloads.append((f"{url}/{source.name}", tmp_path / source.name))
+
+    paths = download_files(downloads, workers=3, progress_bar=True)
+
+    assert paths == [i[1] for i in downloads]
+    for n, path in enumerate(paths):
+        assert path.read_bytes() == bytes([n]) * (n + 1) * 1000
+
+
+def test_download_file_cache(tmp_path, file_server):
+    """Test that partial downloads are resumed, and cached files are revalidated."""
+
+    served, url = file_server
+    source = served / "cb_2018_us_state_500k.zip"
+    source.write_bytes(b"0123456789" * 100)
+    filepath = tmp_path / source.name
+    requests = RangeRequestHandler.requests
+
+    download_file(f"{url}/{source.name}", filepath)
+    assert filepath.read_bytes() == source.read_bytes()
+    assert not (tmp_path / f"{source.name}.part").exists()
+
+    # simulate an interrupted download, which should only fetch the missing bytes
+    part_path = tmp_path / f"{source.name}.part"
+    filepath.rename(part_path)
+    part_path.write_bytes(source.read_bytes()[:400])
+    download_file(f"{url}/{source.name}", filepath)
+    assert requests[-1]["Range"] == "bytes=400-"
+    assert filepath.read_bytes() == source.read_bytes()
+
+    # revalidating an unchanged file doesn't download it again
+    mtime = filepath.stat().st_mtime_ns
+    download_file(f"{url}/{source.name}", filepath, no_cache=True)
+    assert "If-None-Match" in requests[-1]
+    assert filepath.stat().st_mtime_ns == mtime
+
+    # but a changed file is replaced
+    source.write_bytes(b"abc")
+    download_file(f"{url}/{source.name}", filepath, no_cache=True)
+    assert filepath.read_bytes() == b"abc"